@@ -1,27 +1,58 @@
 from contextlib import contextmanager
 import posixpath
 
-from fabric.api import run, env
+from fabric.api import run, env, sudo
 from fabric.context_managers import prefix, settings, hide
 from fabric.contrib.files import exists
+from fabric.utils import abort
 
 # Credits to Andreas Nüßlein. This a copy of his fabric3-virtualenv package which
 # has been deleted from pypi. When I get around to updating this package to use
 # Fabric2, then we can remove this package
 
-# Default virtualenv command
-env.virtualenv = 'virtualenv'
+# Default virtualenv command, see prepare_virtualenv()
+env.virtualenv = 'python3 -m venv'
 
-# URL of the standalone virtualenv.py
-VIRTUALENV_PY_URL = \
-    'https://raw.github.com/pypa/virtualenv/master/virtualenv.py'
+# Where pip keeps downloads and built wheels, shared by every environment
+# created by the same user.
+env.pip_cache_dir = '~/.cache/pip'
+
+# (host, path) of the virtualenvs which we've seen exist this session.
+_verified = set()
+
+
+def _run(command, warn_only=False, user=None):
+    """Run a command with env.execution_backend when one has been set up
+    (see server_management), otherwise with fabric's run (or sudo, if a user
+    is given)."""
+    backend = env.get('execution_backend')
+    if backend is None:
+        with settings(warn_only=warn_only):
+            if user:
+                return sudo(command, user=user)
+            return run(command)
+
+    result = backend.run(command, user=user)
+    if result.failed and not (warn_only or env.warn_only):
+        abort("%s failed:\n%s" % (command, result.stderr or result))
+    return result
+
+
+def _exists(path):
+    backend = env.get('execution_backend')
+    if backend is None:
+        return exists(path)
+    return backend.run('test -e "$(echo %s)"' % path, quiet=True).succeeded
 
 
 @contextmanager
-def virtualenv(path):
+def virtualenv(path, verify=True):
     """Context manager that performs commands with an active virtualenv, eg:
 
     path is the path to the virtualenv to apply
+    verify can be set to False to skip checking that the virtualenv exists,
+    when the caller already knows that it does. Each path is only checked
+    once per host.
 
     >>> with virtualenv(env):
             run('python foo')
@@ -32,47 +63,36 @@ def virtualenv(path):
 
     """
     activate = posixpath.join(path, 'bin/activate')
-    if not exists(activate):
-        raise OSError("Cannot activate virtualenv %s" % path)
+    if verify and (env.host_string, path) not in _verified:
+        if not _exists(activate):
+            raise OSError("Cannot activate virtualenv %s" % path)
+        _verified.add((env.host_string, path))
     with prefix('. %s' % activate):
         yield
 
 
-def _wget(url, out):
-    """Helper for downloading a file, without requiring wget/curl etc."""
-    cmd = (
-        "python -c 'import urllib2,sys; "
-        "print urllib2.urlopen(sys.argv[1]).read()' '{url}' >{out}"
-    )
-    run(cmd.format(url=url, out=out))
-
-
 def prepare_virtualenv():
     """Prepare a working virtualenv command.
 
-    The command will be available as env.virtualenv.
+    The command will be available as env.virtualenv. The standard library's
+    venv is used where it works (Debian packages ensurepip separately, as
+    pythonX.Y-venv), otherwise an installed virtualenv.
     """
     with hide('output', 'running'):
-        venv = run('which virtualenv ; :')
-        if venv:
-            env.virtualenv = venv
+        if _run('python3 -c "import ensurepip, venv"', warn_only=True).succeeded:
+            env.virtualenv = 'python3 -m venv'
             return
 
-        if not exists('~/virtualenv.py'):
-            _wget(VIRTUALENV_PY_URL, '~/virtualenv.py')
-            run('chmod 755 ~/virtualenv.py')
-        else:
-            mode = int(run('stat -c %a ~/virtualenv.py'), 8)
-            if mode & 0o2:
-                raise IOError(
-                    "~/virtualenv.py is world-writable. "
-                    "Not using for security reasons."
-                )
-        env.virtualenv = '~/virtualenv.py'
+        venv = _run('which virtualenv ; :')
+        if not venv:
+            raise OSError(
+                "Neither venv (with ensurepip) nor virtualenv is available."
+            )
+        env.virtualenv = venv
 
 
 def make_virtualenv(path, dependencies=[], eggs=[], system_site_packages=True,
-                    python_binary=None):
+                    python_binary=None, requirements=None, user=None):
     """Create or update a virtualenv in path.
 
     :param path: The path to the virtualenv. This path will be created if it
@@ -83,37 +103,58 @@ def make_virtualenv(path, dependencies=[], eggs=[], system_site_packages=True,
     :param system_site_packages: If True, the newly-created virtualenv will
         expose the system site package. If False, these will be hidden.
     :param python_binary: If not None, should be the path to python binary
-        that will be used to create the virtualenv.
+        that will be used to create the virtualenv (with its venv module).
+    :param requirements: If not None, the path to a requirements file which
+        is installed along with the dependencies, when it exists.
+    :param user: If not None, the user to create the virtualenv as.
+
+    The dependencies and requirements are installed with a single pip
+    command, so they're resolved together, using env.pip_cache_dir.
 
     """
-    if not exists(path):
-        version = tuple(run('%s --version' % env.virtualenv).split('.'))
-        if version >= (1, 7):
-            args = '--system-site-packages' if system_site_packages else ''
-        else:
-            args = '--no-site-packages' if not system_site_packages else ''
-
-        if python_binary:
-            args += '-p {}'.format(python_binary)
-
-        run('{virtualenv} {args} {path}'.format(
-            virtualenv=env.virtualenv,
-            args=args,
-            path=path
-        ))
+    if python_binary:
+        create = '%s -m venv' % python_binary
     else:
-        # Update system-site-packages
-        no_global_path = posixpath.join(
-            path, 'lib/python*/no-global-site-packages.txt'
-        )
-        if system_site_packages:
-            run('rm -f ' + no_global_path)
-        else:
-            run('touch ' + no_global_path)
-
-    with virtualenv(path):
-        for e in eggs:
-            with settings(warn_only=True):
-                run("easy_install '%s'" % e)
-        for d in dependencies:
-            run("pip install '%s'" % d)
+        create = env.virtualenv
+
+    # Creating, or updating system-site-packages, is one round-trip.
+    # virtualenvs made before pyvenv.cfg existed use
+    # no-global-site-packages.txt instead.
+    config = posixpath.join(path, 'pyvenv.cfg')
+    no_global_path = posixpath.join(
+        path, 'lib/python*/no-global-site-packages.txt'
+    )
+    _run(
+        'if [ ! -e {path} ]; then '
+        '{create} {args} {path} && {path}/bin/pip install -q --cache-dir {cache} -U pip; '
+        'elif [ -f {config} ]; then '
+        'sed -i "s/^include-system-site-packages = .*/include-system-site-packages = {include}/" {config}; '
+        'else {no_global}; fi'.format(
+            path=path,
+            create=create,
+            args='--system-site-packages' if system_site_packages else '',
+            cache=env.pip_cache_dir,
+            config=config,
+            include='true' if system_site_packages else 'false',
+            no_global=('rm -f ' if system_site_packages else 'touch ') + no_global_path,
+        ),
+        user=user,
+    )
+    _verified.add((env.host_string, path))
+
+    with virtualenv(path, verify=False):
+        if eggs:
+            _run('easy_install %s' % ' '.join("'%s'" % e for e in eggs),
+                 warn_only=True, user=user)
+
+        packages = ' '.join("'%s'" % d for d in dependencies)
+        if requirements:
+            packages = '$(test -f {0} && echo "-r {0}") {1}'.format(
+                requirements, packages
+            )
+
+        if dependencies or requirements:
+            _run('pip install --cache-dir {cache} {packages}'.format(
+                cache=env.pip_cache_dir,
+                packages=packages,
+            ), user=user)
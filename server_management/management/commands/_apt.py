@@ -0,0 +1,91 @@
+from fabric.api import hide, run, settings
+
+# Newer versions of add-apt-repository run an `apt-get update` every time a
+# source is added, unless told not to. Older versions don't know the flag.
+ADD_REPOSITORY = (
+    "if add-apt-repository --help | grep -q -- '--no-update'; then flags=-n; fi; "
+    "add-apt-repository -y $flags {}"
+)
+
+
+def parse_installed(output):
+    # Output of `dpkg-query -W -f='${Package} ${db:Status-Abbrev}\n'`.
+    installed = set()
+
+    for line in output.splitlines():
+        parts = line.split()
+
+        if len(parts) >= 2 and parts[1].startswith('ii'):
+            installed.add(parts[0])
+
+    return installed
+
+
+def installed_packages(packages):
+    with hide('output', 'running', 'warnings'), settings(warn_only=True):
+        # dpkg-query exits non-zero if any of the packages are unknown, which
+        # is fine, it still lists the ones it knows about.
+        output = run("dpkg-query -W -f='${{Package}} ${{db:Status-Abbrev}}\\n' {} 2>/dev/null".format(
+            ' '.join(packages),
+        ))
+
+    return parse_installed(output)
+
+
+def apt_tasks(packages, repositories=None, proxy=None, installed=None):
+    # Everything apt related, with as few trips to the network as possible:
+    # sources are added first, the cache is updated once and a single install
+    # is made of whichever packages are missing.
+    packages = [package for package in packages if package]
+    repositories = repositories or []
+
+    if installed is None:
+        installed = installed_packages(packages)
+
+    missing = [package for package in packages if package not in installed]
+
+    if proxy:
+        proxy_task = {
+            'title': 'Configure the apt proxy',
+            'command': f'echo \'Acquire::http::Proxy "{proxy}";\' > /etc/apt/apt.conf.d/01proxy',
+        }
+    else:
+        proxy_task = {
+            'title': 'Ensure no apt proxy is configured',
+            'command': 'rm -f /etc/apt/apt.conf.d/01proxy',
+        }
+
+    tasks = [proxy_task]
+
+    tasks.extend([
+        {
+            'title': f'Add {repository} repository',
+            'command': ADD_REPOSITORY.format(repository),
+            'check': 'grep -rqs "^deb .*{}" /etc/apt/sources.list /etc/apt/sources.list.d/'.format(
+                repository.replace('ppa:', ''),
+            ),
+        }
+        for repository in repositories
+    ])
+
+    tasks.extend([
+        {
+            'title': 'Update apt cache',
+            'command': 'apt-get update',
+        },
+        {
+            'title': 'Upgrade everything',
+            'command': 'apt-get upgrade -yq',
+        },
+    ])
+
+    if missing:
+        tasks.append({
+            'title': 'Install {} missing package{}'.format(
+                len(missing),
+                '' if len(missing) == 1 else 's',
+            ),
+            'command': 'apt-get install -y {}'.format(' '.join(missing)),
+        })
+
+    return tasks
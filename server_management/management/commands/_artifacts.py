@@ -0,0 +1,121 @@
+import os
+import subprocess
+
+from fabric.api import hide, put, run, settings
+
+from ._core import TaskFailed, TaskResult, get_cache_dir, title_print
+
+
+class Artifact(object):
+    # Something which is slow to produce (DH parameters, keys, ...) and can be
+    # generated locally once, then uploaded to any number of servers.
+
+    def __init__(self, name, generate_command, check_command, remote_path, mode=0o644):
+        self.name = name
+        self.generate_command = generate_command
+        self.check_command = check_command
+        self.remote_path = remote_path
+        self.mode = mode
+
+
+DHPARAM = Artifact(
+    name='dhparam-2048.pem',
+    generate_command=['openssl', 'dhparam', '-out', '{path}', '2048'],
+    check_command='openssl dhparam -in {path} -noout -text 2>/dev/null | grep -q "(2048 bit)"',
+    remote_path='/etc/ssl/dhparam.pem',
+)
+
+
+class ArtifactCache(object):
+
+    def __init__(self):
+        self.directory = get_cache_dir('artifacts')
+        self.processes = {}
+
+    def path(self, artifact):
+        return os.path.join(self.directory, artifact.name)
+
+    def promote(self, artifact):
+        # Move a finished generation into the cache. It may have been left by
+        # an earlier run which didn't need to wait for it.
+        path = self.path(artifact)
+        check = artifact.check_command.format(path=path + '.tmp')
+
+        if os.path.exists(path + '.tmp') and subprocess.run(check, shell=True).returncode == 0:
+            os.rename(path + '.tmp', path)
+
+        return os.path.exists(path)
+
+    def prepare(self, *artifacts):
+        # Start generating anything we don't have yet in the background, so it
+        # is (hopefully) ready by the time the deploy gets round to needing it.
+        for artifact in artifacts:
+            if artifact.name in self.processes or self.promote(artifact):
+                continue
+
+            command = [
+                part.format(path=self.path(artifact) + '.tmp')
+                for part in artifact.generate_command
+            ]
+
+            try:
+                self.processes[artifact.name] = subprocess.Popen(
+                    command,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            except OSError:
+                # The generator isn't available locally, `wait` will report it.
+                self.processes[artifact.name] = None
+
+    def wait(self, artifact):
+        # Returns the local path of the artifact, or None if it couldn't be made.
+        path = self.path(artifact)
+
+        if artifact.name not in self.processes:
+            self.prepare(artifact)
+
+        process = self.processes.pop(artifact.name, None)
+
+        if process is not None:
+            if process.wait() == 0:
+                os.rename(path + '.tmp', path)
+            elif os.path.exists(path + '.tmp'):
+                os.unlink(path + '.tmp')
+
+        return path if os.path.exists(path) else None
+
+    def release(self, artifact):
+        # The server didn't need it. A generation which has finished goes into
+        # the cache now, one which hasn't is left to finish on its own and is
+        # picked up by the next prepare().
+        process = self.processes.pop(artifact.name, None)
+
+        if process is not None and process.poll() is not None:
+            self.promote(artifact)
+
+    def install(self, artifact, title):
+        # Make sure the artifact is on the server, reusing whatever is there if
+        # it's still valid.
+        title_print(title, state='task')
+
+        with hide('output', 'running', 'warnings'), settings(warn_only=True):
+            if run(artifact.check_command.format(path=artifact.remote_path)).succeeded:
+                self.release(artifact)
+                title_print(title, state='succeeded')
+                return
+
+        path = self.wait(artifact)
+
+        if path:
+            result = put(path, artifact.remote_path, mode=artifact.mode)
+        else:
+            # Couldn't generate it locally, fall back to doing it on the server.
+            with settings(warn_only=True):
+                result = run(' '.join(artifact.generate_command).format(path=artifact.remote_path))
+
+        if result.succeeded:
+            title_print(title, state='succeeded')
+        else:
+            title_print(title, state='failed')
+            raise TaskFailed([TaskResult(title, 'failed', stdout=str(result), return_code=getattr(result, 'return_code', None))])
@@ -0,0 +1,284 @@
+import asyncio
+import functools
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import uuid
+from concurrent.futures import Future
+
+from django.core.management.base import CommandError
+from fabric.api import env, hide, local, put, run, settings, sudo
+from fabric.network import normalize
+from fabric.operations import (_AttributeList, _AttributeString,
+                               _prefix_commands, _prefix_env_vars)
+from fabric.state import output
+
+# OpenSSH allows 10 sessions per connection by default (MaxSessions), keep a
+# couple spare for anything else using the master connection.
+CHANNELS_PER_HOST = 8
+
+
+def command_result(stdout, stderr, return_code, command):
+    # Something which looks like the result of fabric's `run` or `local`.
+    result = _AttributeString(stdout)
+    result.stderr = stderr
+    result.return_code = return_code
+    result.succeeded = return_code == 0
+    result.failed = not result.succeeded
+    result.command = command
+    result.real_command = command
+    return result
+
+
+def put_result(remote_path, succeeded):
+    result = _AttributeList([remote_path] if succeeded else [])
+    result.failed = [] if succeeded else [remote_path]
+    result.succeeded = succeeded
+    return result
+
+
+def completed(function, *args, **kwargs):
+    future = Future()
+
+    try:
+        future.set_result(function(*args, **kwargs))
+    except Exception as e:  # pylint: disable=broad-except
+        future.set_exception(e)
+
+    return future
+
+
+class BlockingBackend(object):
+    # Fabric's own operations, one after another. Always available, and what
+    # is used unless a remote asks for something else.
+
+    name = 'blocking'
+    concurrent = False
+
+    def run(self, command, user=None, quiet=False):
+        # Failures are returned rather than aborting, like `warn_only`.
+        hidden = ('output', 'running', 'warnings') if quiet else ()
+
+        with hide(*hidden), settings(warn_only=True):
+            if user:
+                return sudo(command, user=user, combine_stderr=False)
+            return run(command, combine_stderr=False)
+
+    def put(self, local_path, remote_path, use_sudo=False, mode=None):
+        with settings(warn_only=True):
+            return put(local_path, remote_path, use_sudo=use_sudo, mode=mode)
+
+    def local(self, command):
+        with settings(warn_only=True):
+            return local(command, capture=True)
+
+    # The `_async` variants return a concurrent.futures.Future. Here the work
+    # is done before they return, they only exist so callers don't need to
+    # care which backend they have.
+    def run_async(self, command, user=None, quiet=False):
+        return completed(self.run, command, user=user, quiet=quiet)
+
+    def local_async(self, command):
+        return completed(self.local, command)
+
+    def call_async(self, function, *args, **kwargs):
+        return completed(function, *args, **kwargs)
+
+    @staticmethod
+    def wait(futures):
+        return [future.result() for future in futures]
+
+    def close(self):
+        pass
+
+
+class AsyncBackend(BlockingBackend):
+    # Runs remote commands as OpenSSH subprocesses on an asyncio loop (in its
+    # own thread). They share one multiplexed connection (ControlMaster), so
+    # each command opens a channel rather than a new connection, and up to
+    # `channels` of them run at once. Local commands and functions started
+    # with `call_async` run alongside them.
+
+    name = 'async'
+    concurrent = True
+
+    def __init__(self, host_string=None, channels=CHANNELS_PER_HOST):
+        self.user, self.host, self.port = normalize(host_string or env.host_string)
+        self.control_dir = tempfile.mkdtemp(prefix='server-management-ssh-')
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.channels = self.submit(self._semaphore(channels)).result()
+
+    @staticmethod
+    async def _semaphore(channels):
+        # Created on the loop, older Pythons bind it to the current loop.
+        return asyncio.Semaphore(channels)
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def ssh_options(self):
+        options = [
+            '-o', 'BatchMode=yes',
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={}'.format(os.path.join(self.control_dir, '%C')),
+            # Kept open until close(). deploy logs in as root and then locks
+            # root out, so a dropped master can't always be reopened.
+            '-o', 'ControlPersist=yes',
+            '-o', 'LogLevel=ERROR',
+        ]
+
+        if env.disable_known_hosts:
+            options += ['-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null']
+
+        key_filenames = env.key_filename or []
+        if isinstance(key_filenames, str):
+            key_filenames = [key_filenames]
+
+        for key_filename in key_filenames:
+            options += ['-i', os.path.expanduser(key_filename)]
+
+        return options
+
+    def ssh_command(self, command):
+        return ['ssh', *self.ssh_options(), '-p', str(self.port), f'{self.user}@{self.host}', command]
+
+    def remote_command(self, command, user=None):
+        # Apply fabric's cd(), prefix() and shell_env() as `run` would. This
+        # has to happen in the calling thread, where those are active.
+        command = '{} {}'.format(env.shell, shlex.quote(_prefix_env_vars(_prefix_commands(command, 'remote'))))
+
+        if user and user != self.user:
+            command = f'sudo -n -H -u {user} {command}'
+
+        return command
+
+    def connect(self):
+        # Opens the master connection, returns False if we can't log in
+        # without a prompt (the blocking backend can ask for passwords).
+        return self.run('true', quiet=True).succeeded
+
+    async def _execute(self, *args, shell=False):
+        if shell:
+            process = await asyncio.create_subprocess_shell(
+                args[0], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+        else:
+            process = await asyncio.create_subprocess_exec(
+                *args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+
+        stdout, stderr = await process.communicate()
+        return process.returncode, stdout.decode('utf-8', 'replace').strip(), stderr.decode('utf-8', 'replace').strip()
+
+    async def _run(self, command, remote_command, quiet):
+        async with self.channels:
+            return_code, stdout, stderr = await self._execute(*self.ssh_command(remote_command))
+
+        if output['stdout'] and not quiet and stdout:
+            print('\n'.join(f'[{self.host}] out: {line}' for line in stdout.splitlines()))
+
+        return command_result(stdout, stderr, return_code, command)
+
+    async def _put(self, local_path, remote_path, use_sudo, mode):
+        # scp can't write somewhere we need sudo for, so those go via /tmp.
+        destination = f'/tmp/server-management-{uuid.uuid4().hex}' if use_sudo else remote_path
+
+        async with self.channels:
+            return_code, _, _ = await self._execute(
+                'scp', '-q', *self.ssh_options(), '-P', str(self.port), local_path, f'{self.user}@{self.host}:{destination}',
+            )
+
+        commands = []
+        if use_sudo:
+            commands.append(f'sudo -n mv {destination} {remote_path}')
+        if mode is not None:
+            commands.append('{}chmod {:o} {}'.format('sudo -n ' if use_sudo else '', mode, remote_path))
+
+        if return_code == 0 and commands:
+            result = await self._run(' && '.join(commands), self.remote_command(' && '.join(commands)), quiet=True)
+            return_code = result.return_code
+
+        return put_result(remote_path, return_code == 0)
+
+    async def _local(self, command, local_command):
+        return_code, stdout, stderr = await self._execute(local_command, shell=True)
+        return command_result(stdout, stderr, return_code, command)
+
+    async def _call(self, function, *args, **kwargs):
+        return await self.loop.run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+    def run(self, command, user=None, quiet=False):
+        return self.run_async(command, user=user, quiet=quiet).result()
+
+    def put(self, local_path, remote_path, use_sudo=False, mode=None):
+        if not hasattr(local_path, 'read'):
+            return self.submit(self._put(os.path.expanduser(local_path), remote_path, use_sudo, mode)).result()
+
+        # scp needs a file, so write out file-like objects (StringIO) first.
+        data = local_path.read()
+
+        with tempfile.NamedTemporaryFile('wb', delete=False) as temporary_file:
+            temporary_file.write(data.encode('utf-8') if isinstance(data, str) else data)
+
+        try:
+            return self.submit(self._put(temporary_file.name, remote_path, use_sudo, mode)).result()
+        finally:
+            os.unlink(temporary_file.name)
+
+    def local(self, command):
+        return self.local_async(command).result()
+
+    def run_async(self, command, user=None, quiet=False):
+        return self.submit(self._run(command, self.remote_command(command, user=user), quiet))
+
+    def local_async(self, command):
+        return self.submit(self._local(command, _prefix_env_vars(_prefix_commands(command, 'local'), local=True)))
+
+    def call_async(self, function, *args, **kwargs):
+        return self.submit(self._call(function, *args, **kwargs))
+
+    def close(self):
+        subprocess.run(
+            ['ssh', *self.ssh_options(), '-p', str(self.port), '-O', 'exit', f'{self.user}@{self.host}'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+
+BACKENDS = {
+    'blocking': BlockingBackend,
+    'async': AsyncBackend,
+}
+
+
+def get_backend(name='blocking'):
+    if name not in BACKENDS:
+        raise CommandError('Unknown execution backend `{}`, use one of: {}.'.format(name, ', '.join(BACKENDS)))
+
+    if name == 'async':
+        # Needs the OpenSSH client, and logins which don't prompt.
+        if shutil.which('ssh') and shutil.which('scp') and not env.password:
+            backend = AsyncBackend()
+
+            if backend.connect():
+                return backend
+
+            backend.close()
+
+        print('Unable to open a multiplexed SSH connection, using the blocking backend.')
+
+    return BlockingBackend()
+
+
+def current_backend(env):  # pylint: disable=redefined-outer-name
+    if not env.get('execution_backend'):
+        env.execution_backend = BlockingBackend()
+
+    return env.execution_backend
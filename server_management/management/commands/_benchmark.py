@@ -0,0 +1,216 @@
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+import fabric.operations
+from fabric.api import env
+from fabric.operations import _AttributeList, _AttributeString
+from fabric.utils import abort
+
+PATCHED = ('run', 'sudo', 'put', 'get', 'local')
+
+# Remote commands which can't sensibly be run on the local machine. They are
+# "run" with the latency applied and succeed with no output.
+SIMULATED = re.compile(
+    r'(^|[\s;&|(])(git|pip|pip3|virtualenv|yarn|npm|nvm|supervisorctl|service|systemctl|apt-get|chown|'
+    r'python manage\.py|createuser)\b'
+)
+
+# Absolute paths on the "server" which are moved into the sandbox.
+REMOTE_PATHS = re.compile(r'(^|[\s\'"=:>(])/(home|var/www|tmp|etc)/')
+
+# Archives unpacked over the server's root (`tar -C /`).
+UNPACK_ROOT = re.compile(r'(\s-C\s+)/(\s|;|$)')
+
+SU_COMMAND = re.compile(r'^su - \S+ -c ([\'"])(.*)\1$')
+
+# A new SSH connection (scp, rsync) costs a few round-trips before any data
+# moves: TCP, key exchange, authentication and opening the channel.
+CONNECTION_ROUND_TRIPS = 4
+
+
+class FakeFabric(object):
+    # Stands in for fabric's remote operations. "Remote" commands run on the
+    # local machine against a sandbox folder, after waiting for the configured
+    # round-trip time, so the management commands can be timed end to end
+    # without a server.
+
+    def __init__(self, remote_root, rtt=0.0, facts=''):
+        self.remote_root = remote_root
+        self.rtt = rtt
+        self.facts = facts
+        self.round_trips = 0
+        self.patches = []
+        self.original_local = fabric.operations.local
+
+    def install(self):
+        originals = {name: getattr(fabric.operations, name) for name in PATCHED}
+        fakes = {name: getattr(self, name) for name in PATCHED}
+
+        for name, module in list(sys.modules.items()):
+            if not name.startswith(('fabric', 'fabvenv', 'server_management')):
+                continue
+
+            for attribute in PATCHED:
+                if getattr(module, attribute, None) is originals[attribute]:
+                    self.patches.append((module, attribute, originals[attribute]))
+                    setattr(module, attribute, fakes[attribute])
+
+    def uninstall(self):
+        for module, attribute, original in self.patches:
+            setattr(module, attribute, original)
+
+        self.patches = []
+
+    def wait(self, round_trips=1):
+        self.round_trips += round_trips
+        time.sleep(self.rtt * round_trips)
+
+    def remote_path(self, path):
+        path = re.sub(r'^~(\w+)/', r'/home/\1/', path)
+        return os.path.join(self.remote_root, path.lstrip('/'))
+
+    def localise(self, command):
+        command = command.strip()
+
+        if command.startswith('sudo '):
+            command = command[5:]
+
+        match = SU_COMMAND.match(command)
+        if match:
+            command = match.group(2)
+
+        command = re.sub(r'~(\w+)/', r'/home/\1/', command)
+        command = REMOTE_PATHS.sub(r'\1{}/\2/'.format(self.remote_root), command)
+        return UNPACK_ROOT.sub(r'\1{}\2'.format(self.remote_root), command)
+
+    @staticmethod
+    def result(stdout, return_code, command):
+        result = _AttributeString(stdout)
+        result.return_code = return_code
+        result.succeeded = return_code == 0
+        result.failed = not result.succeeded
+        result.command = command
+        result.real_command = command
+        result.stderr = ''
+        return result
+
+    def run(self, command, *args, **kwargs):
+        self.wait()
+
+        if 'echo "os_id=' in command:
+            return self.result(self.facts, 0, command)
+
+        if SIMULATED.search(command):
+            return self.result('', 0, command)
+
+        process = subprocess.run(
+            ['/bin/bash', '-c', self.localise(command)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+        result = self.result(process.stdout.strip(), process.returncode, command)
+
+        if result.failed and not (kwargs.get('warn_only') or env.warn_only):
+            abort('Benchmark command failed: {}\n{}'.format(command, result))
+
+        return result
+
+    def sudo(self, command, *args, **kwargs):
+        return self.run(command, *args, **kwargs)
+
+    def put(self, local_path=None, remote_path=None, *args, **kwargs):
+        self.wait()
+
+        destination = self.remote_path(remote_path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+        if hasattr(local_path, 'read'):
+            data = local_path.read()
+
+            with open(destination, 'wb') as output:
+                output.write(data.encode('utf-8') if isinstance(data, str) else data)
+        else:
+            shutil.copyfile(os.path.expanduser(local_path), destination)
+
+        result = _AttributeList([remote_path])
+        result.failed = []
+        result.succeeded = True
+        return result
+
+    def get(self, remote_path=None, local_path=None, *args, **kwargs):
+        self.wait()
+
+        shutil.copyfile(self.remote_path(remote_path), os.path.expanduser(local_path))
+
+        result = _AttributeList([local_path])
+        result.failed = []
+        result.succeeded = True
+        return result
+
+    def local(self, command, *args, **kwargs):
+        # scp / rsync to the server become local copies into the sandbox.
+        address = '{}@{}:'.format(env.user, env.host_string)
+
+        if address in command:
+            self.wait(CONNECTION_ROUND_TRIPS)
+            command = command.replace(address, self.remote_root)
+
+        return self.original_local(command, *args, **kwargs)
+
+
+class ThrowawayPostgres(object):
+    # A private PostgreSQL cluster listening only on a socket in `directory`.
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.data = os.path.join(directory, 'data')
+        self.socket = os.path.join(directory, 'socket')
+
+    @staticmethod
+    def available():
+        return all(shutil.which(binary) for binary in ('initdb', 'pg_ctl', 'pg_dump', 'psql'))
+
+    def start(self):
+        os.makedirs(self.socket, exist_ok=True)
+
+        subprocess.run(['initdb', '-D', self.data, '-A', 'trust', '--no-sync'], check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([
+            'pg_ctl', '-D', self.data, '-w', '-l', os.path.join(self.directory, 'postgres.log'),
+            '-o', "-k {} -c listen_addresses='' -F".format(self.socket),
+            'start',
+        ], check=True, stdout=subprocess.DEVNULL)
+
+    def stop(self):
+        subprocess.run(['pg_ctl', '-D', self.data, '-w', '-m', 'immediate', 'stop'], stdout=subprocess.DEVNULL)
+
+    def psql(self, sql, database='postgres'):
+        subprocess.run(['psql', '-q', '-h', self.socket, '-d', database, '-c', sql], check=True, stdout=subprocess.DEVNULL)
+
+    def create_database(self, name, owner, rows):
+        self.psql(f'DROP DATABASE IF EXISTS {name}')
+        self.psql(f'DO $$ BEGIN CREATE ROLE {owner} SUPERUSER LOGIN; EXCEPTION WHEN duplicate_object THEN NULL; END $$')
+        self.psql(f'CREATE DATABASE {name} OWNER {owner}')
+        self.psql(
+            f'CREATE TABLE benchmark AS SELECT g AS id, md5(g::text) AS value FROM generate_series(1, {rows}) g',
+            database=name,
+        )
+
+
+def make_media(root, files, size):
+    # A synthetic uploads tree, spread over folders like a real one.
+    for index in range(files):
+        folder = os.path.join(root, 'uploads', str(index % 16))
+        os.makedirs(folder, exist_ok=True)
+
+        with open(os.path.join(folder, f'image-{index}.jpg'), 'wb') as output:
+            output.write(os.urandom(size))
+
+
+def empty_folder(path):
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
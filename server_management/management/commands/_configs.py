@@ -0,0 +1,149 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+import time
+
+from fabric.api import env
+
+from ._backends import current_backend
+from ._core import TaskFailed, TaskResult, get_cache_dir, title_print
+
+
+class ConfigFile(object):
+    # A configuration file rendered in memory, and where it goes on the server.
+
+    def __init__(self, remote_path, content, mode=0o644):
+        self.remote_path = remote_path
+        self.content = content.encode('utf-8')
+        self.mode = mode
+
+    @property
+    def digest(self):
+        return hashlib.sha256(self.content).hexdigest()
+
+
+class ConfigRecord(object):
+    # The digests of the configs we last wrote to a host, and which of those
+    # are still waiting for the service using them to be reloaded.
+
+    def __init__(self, host):
+        self.path = os.path.join(get_cache_dir('state'), f'{host}-configs.json')
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as record_file:
+                record = json.load(record_file)
+        except (OSError, ValueError):
+            record = {}
+
+        # Older records only held the digests.
+        if 'digests' not in record:
+            record = {'digests': record}
+
+        self.digests = record['digests']
+        self.pending = set(record.get('pending', []))
+
+    def unchanged(self, config):
+        return self.digests.get(config.remote_path) == config.digest
+
+    def update(self, configs, changed=()):
+        for config in configs:
+            self.digests[config.remote_path] = config.digest
+
+        self.pending.update(config.remote_path for config in changed)
+        self.save()
+
+    def applied(self, configs):
+        self.pending.difference_update(config.remote_path for config in configs)
+        self.save()
+
+    def save(self):
+        with open(self.path, 'w', encoding='utf-8') as record_file:
+            json.dump({'digests': self.digests, 'pending': sorted(self.pending)}, record_file, indent=2, sort_keys=True)
+
+
+def remote_digests(paths):
+    # The sha256 of each of the paths which exist on the server.
+    with_digests = current_backend(env).run('sha256sum {} 2>/dev/null; true'.format(' '.join(paths)), quiet=True)
+    digests = {}
+
+    for line in str(with_digests).splitlines():
+        if line.strip():
+            digest, path = line.split(None, 1)
+            digests[path.strip()] = digest
+
+    return digests
+
+
+def config_archive(configs):
+    buffer = io.BytesIO()
+
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        for config in configs:
+            info = tarfile.TarInfo(config.remote_path.lstrip('/'))
+            info.size = len(config.content)
+            info.mode = config.mode
+            info.mtime = time.time()
+            info.uname = info.gname = 'root'
+            archive.addfile(info, io.BytesIO(config.content))
+
+    buffer.seek(0)
+    return buffer
+
+
+def pending_configs(record, configs):
+    return [config for config in configs if config.remote_path in record.pending]
+
+
+def configs_applied(configs):
+    # Call once the service reading `configs` has been reloaded, until then
+    # upload_configs keeps returning them as changed.
+    ConfigRecord(env.host_string).applied(configs)
+
+
+def upload_configs(configs, title='Upload the configuration files', use_sudo=False, trust_record=False):
+    # Uploads the files which differ from the copies on the server, all in one
+    # archive, and returns those along with any uploaded by an earlier run
+    # which never got to its reload. Missing folders are created as it
+    # unpacks. With `trust_record`, configs matching what we last wrote to the
+    # host aren't checked on the server at all.
+    backend = current_backend(env)
+    record = ConfigRecord(env.host_string)
+    title_print(title, state='task')
+
+    if trust_record and all(record.unchanged(config) for config in configs):
+        title_print(title, state='skipped')
+        return pending_configs(record, configs)
+
+    digests = remote_digests([config.remote_path for config in configs])
+    changed = [config for config in configs if digests.get(config.remote_path) != config.digest]
+
+    if not changed:
+        record.update(configs)
+        title_print(title, state='skipped')
+        return pending_configs(record, configs)
+
+    # The archive is removed by the same command which unpacks it.
+    path = f'/tmp/server_management_configs_{env.user}.tar.gz'
+    result = backend.put(config_archive(changed), path)
+
+    if result.succeeded:
+        result = backend.run(
+            f'tar -xzf {path} -C /; __sm_rc=$?; rm -f {path}; exit $__sm_rc',
+            user='root' if use_sudo else None,
+        )
+
+    if result.failed:
+        title_print(title, state='failed')
+        raise TaskFailed([TaskResult(
+            title,
+            'failed',
+            stdout=str(result) if isinstance(result, str) else '',
+            stderr=getattr(result, 'stderr', ''),
+            return_code=getattr(result, 'return_code', None),
+        )])
+
+    record.update(configs, changed)
+    title_print(title, state='succeeded')
+    return pending_configs(record, configs)
@@ -1,16 +1,23 @@
 from __future__ import print_function
 
+import atexit
+import hashlib
 import json
+import os
 import sys
+import time
+from contextlib import contextmanager
 
 import fabric
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from fabric.api import settings as fabric_settings
-from fabric.api import fastprint, hide, prompt, run, sudo
-from fabric.colors import green, red, yellow
+from fabric.api import fastprint, hide, prompt, run
+from fabric.colors import cyan, green, red, yellow
 from fabric.contrib.console import confirm
 
+from ._backends import command_result, completed, current_backend, get_backend
+
 
 class ServerManagementBaseCommand(BaseCommand):  # pylint: disable=abstract-method
 
@@ -93,6 +100,10 @@ def load_config(env, remote=None, config_user='deploy', debug=False):  # pylint:
                 print('Failed to connect to remote server')
                 exit()
 
+    # How remote commands are executed, see _backends.py.
+    env.execution_backend = get_backend(remote['server'].get('backend', 'blocking'))
+    atexit.register(env.execution_backend.close)
+
     if not debug:
         # Change the output to be less verbose.
         fabric.state.output['stdout'] = False
@@ -102,15 +113,19 @@ def load_config(env, remote=None, config_user='deploy', debug=False):  # pylint:
     return config, remote
 
 
-def get_remote(remote):
+def get_config():
     # Load the json file
     try:
         with open(f'{settings.SITE_ROOT}/server.json', 'r', encoding='utf-8') as json_data:
-            config = json.load(json_data)
+            return json.load(json_data)
     except Exception as e:
         print(e)
         raise Exception('Something is wrong with the server.json file, make sure it exists and is valid JSON.')
 
+
+def get_remote(remote):
+    config = get_config()
+
     # Define current host from settings in server config
     # First check if there is a single remote or multiple.
     if 'remotes' not in config or not config['remotes']:
@@ -135,6 +150,17 @@ def get_remote(remote):
     return remote_prompt, config
 
 
+def get_cache_dir(*parts):
+    # Local storage for things we want to keep between runs (generated
+    # artifacts, state, reports). Can be moved with a Django setting.
+    path = os.path.join(
+        os.path.expanduser(getattr(settings, 'SERVER_MANAGEMENT_CACHE_DIR', '~/.server-management')),
+        *parts
+    )
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
 def title_print(title, state=''):
     if state == 'task':
         fastprint('[{}] {} ... '.format(
@@ -146,36 +172,504 @@ def title_print(title, state=''):
             green('TASK'),
             title,
         ), end='\n')
+    elif state == 'skipped':
+        fastprint('\r[{}] {} ... skipped'.format(
+            cyan('TASK'),
+            title,
+        ), end='\n')
     elif state == 'failed':
         fastprint('\r[{}] {} ... failed'.format(
             red('TASK'),
             title,
         ), end='\n')
 
-        exit()
 
+class TaskResult(object):
 
-def check_request(task, result):
-    if result.succeeded:
-        title_print(task['title'], state='succeeded')
-    elif result.failed:
-        title_print(task['title'], state='failed')
+    def __init__(self, title, state, stdout='', stderr='', return_code=None, duration=0.0, attempts=0):  # pylint: disable=too-many-arguments
+        self.title = title
+        self.state = state
+        self.stdout = stdout
+        self.stderr = stderr
+        self.return_code = return_code
+        self.duration = duration
+        self.attempts = attempts
 
+    @property
+    def succeeded(self):
+        return self.state in ('succeeded', 'skipped')
+
+    @property
+    def failed(self):
+        return self.state == 'failed'
+
+    def __repr__(self):
+        return '<TaskResult {!r} {}>'.format(self.title, self.state)
+
+
+class TaskFailed(CommandError):
+
+    def __init__(self, results):
+        self.results = results
+
+        failed = [result for result in results if result.failed]
+        details = '\n'.join(
+            '{} (exit code {}):\n{}'.format(result.title, result.return_code, result.stderr or result.stdout)
+            for result in failed
+        )
+
+        super(TaskFailed, self).__init__('{} task{} failed.\n{}'.format(
+            len(failed),
+            '' if len(failed) == 1 else 's',
+            details,
+        ))
+
+
+# Failures which are worth another go, e.g. unattended-upgrades holding the
+# apt lock just after a server boots, or a network blip.
+TRANSIENT_ERRORS = (
+    'Could not get lock',
+    'Unable to acquire the dpkg frontend lock',
+    'Temporary failure resolving',
+    'Temporary failure in name resolution',
+    'Could not resolve',
+    'Connection timed out',
+    'Connection reset by peer',
+    'Failed to fetch',
+)
+
+
+def is_transient(task, output):
+    patterns = task.get('retry_on', TRANSIENT_ERRORS)
+    return any(pattern in output for pattern in patterns)
+
+
+def parse_policy(policy):
+    # Returns (stop on failure, number of retries) for a group policy:
+    # 'fail-fast', 'continue' or 'retry-<n>' (retry, then fail fast).
+    if policy == 'fail-fast':
+        return True, 0
+    if policy == 'continue':
+        return False, 0
+    if policy.startswith('retry-'):
+        return True, int(policy[len('retry-'):])
+    raise ValueError('Unknown task policy `{}`.'.format(policy))
+
+
+class TaskJournal(object):
+    # Records which tasks have completed against a host, so that a failed run
+    # can be resumed from the step which failed rather than from the start.
+
+    def __init__(self, name, host, resume=False):
+        self.path = os.path.join(get_cache_dir('state'), '{}-{}.json'.format(host, name))
+        self.completed = set()
+
+        if resume and os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as journal_file:
+                self.completed = set(json.load(journal_file))
+        else:
+            self.save()
+
+    @staticmethod
+    def task_key(task):
+        # Titles aren't unique on their own, so include what the task does.
+        return hashlib.sha1(json.dumps([
+            task['title'],
+            task.get('command', ''),
+            task.get('fabric_command', ''),
+            task.get('fabric_args', []),
+        ], default=str).encode('utf-8')).hexdigest()
+
+    def is_complete(self, task):
+        return self.task_key(task) in self.completed
+
+    def mark_complete(self, task):
+        self.completed.add(self.task_key(task))
+        self.save()
+
+    def save(self):
+        with open(self.path, 'w', encoding='utf-8') as journal_file:
+            json.dump(sorted(self.completed), journal_file)
+
+
+class RunReport(object):
+    # Timings for each step of a run, written to the local history so runs can
+    # be compared with `deploystats`.
+
+    def __init__(self, command, host):
+        self.command = command
+        self.host = host
+        self.started = time.time()
+        self.steps = []
+
+    def add(self, title, duration, state='succeeded', remote_duration=None, transferred=0):
+        self.steps.append({
+            'title': title,
+            'state': state,
+            'duration': round(duration, 3),
+            'remote_duration': None if remote_duration is None else round(remote_duration, 3),
+            'transferred': transferred,
+        })
+
+    def save(self):
+        path = os.path.join(
+            get_cache_dir('reports', self.host),
+            '{}-{}.json'.format(self.command, time.strftime('%Y%m%d%H%M%S', time.localtime(self.started))),
+        )
+
+        with open(path, 'w', encoding='utf-8') as report_file:
+            json.dump({
+                'command': self.command,
+                'host': self.host,
+                'started': self.started,
+                'duration': round(time.time() - self.started, 3),
+                'steps': self.steps,
+            }, report_file, indent=2)
+
+
+def start_report(env, command):
+    env.run_report = RunReport(command, env.host_string)
+
+    # Saved at exit, so a run stopped by TaskFailed (or anything else) still
+    # leaves its report, which is when it's most useful.
+    atexit.register(env.run_report.save)
+
+    return env.run_report
+
+
+@contextmanager
+def report_step(env, title):
+    # Time a step which doesn't go through run_tasks.
+    started = time.monotonic()
+    state = 'failed'
+
+    try:
+        yield
+        state = 'succeeded'
+    finally:
+        if env.get('run_report'):
+            env.run_report.add(title, time.monotonic() - started, state=state)
+
+
+# Wraps a remote command so it reports how long it took on the server, which
+# tells us how much of a task's time is spent on the network.
+REMOTE_TIMER = '__sm_start=$(date +%s%N); ( {} ); __sm_rc=$?; echo "__SM_REMOTE_NS $(( $(date +%s%N) - __sm_start ))"; exit $__sm_rc'
+
+
+def measured_duration(result):
+    for line in reversed(str(result).splitlines()):
+        if line.startswith('__SM_REMOTE_NS '):
+            return int(line.split()[1]) / 1e9
+    return None
+
+
+def strip_timer(output):
+    return '\n'.join(line for line in output.splitlines() if not line.startswith('__SM_REMOTE_NS '))
+
+
+def transfer_size(task):
+    # Bytes sent by a `put` task.
+    if task.get('fabric_command') != 'put' or not task.get('fabric_args'):
+        return 0
+
+    source = task['fabric_args'][0]
+
+    if isinstance(source, str):
+        source = os.path.expanduser(source)
+        return os.path.getsize(source) if os.path.isfile(source) else 0
+    if hasattr(source, 'getvalue'):
+        return len(source.getvalue())
+    return 0
+
+
+def is_satisfied(task, user=None):
+    # A task can declare a `check`, either a callable or a shell command which
+    # exits 0 when the task doesn't need to run (e.g. the user already exists).
+    check = task.get('check')
+
+    if not check:
+        return False
+
+    if callable(check):
+        return check()
+
+    return current_backend(fabric.api.env).run(check, user=user, quiet=True).succeeded
+
+
+def task_command(task, report=None):
+    return REMOTE_TIMER.format(task['command']) if report else task['command']
+
+
+def execute_task(task, user=None, report=None):
+    # Run a single task, returning the fabric result. Failures are returned
+    # rather than aborting, run_tasks decides what to do with them.
+
+    # Generic command
+    if 'command' in task:
+        return current_backend(fabric.api.env).run(task_command(task, report), user=user)
+
+    # Fabric API
+    with fabric_settings(warn_only=True):
+        return getattr(fabric.api, task['fabric_command'])(*task.get('fabric_args', []), **task.get('fabric_kwargs', {}))
+
+
+def start_concurrent(tasks, should_skip, user=None, report=None):
+    # Starts a run of consecutive `concurrent` command tasks together, each on
+    # its own channel. Returns {id(task): future}, with None for tasks which
+    # are skipped.
+    backend = current_backend(fabric.api.env)
+    started = {}
 
-def run_tasks(env, tasks, user=None):
-    # Loop tasks
     for task in tasks:
-        title_print(task['title'], state='task')
+        if not task.get('concurrent') or 'command' not in task:
+            break
 
-        # Generic command
-        if 'command' in task:
-            if user:
-                task_result = sudo(task['command'], user=user)
-            else:
-                task_result = run(task['command'])
-        # Fabric API
-        elif 'fabric_command' in task:
-            task_result = getattr(fabric.api, task['fabric_command'])(*task.get('fabric_args', []), **task.get('fabric_kwargs', {}))
+        started[id(task)] = None if should_skip(task) else backend.run_async(task_command(task, report), user=user)
+
+    return started
+
+
+# Each step of a batch script ends by printing its marker, on stdout with the
+# exit code (or "skipped") and the time it took, and on stderr so that the
+# output can be split between the tasks. The markers start on a new line in
+# case the command's output doesn't end with one. The script itself is bash's
+# stdin, so the steps get /dev/null instead, or anything reading its input
+# (apt, ssh-keygen, a prompt) would swallow the steps after it.
+BATCH_STEP = """__sm_start=$(date +%s%N)
+if {check}; then __sm_rc=skipped; else ( {command} ) </dev/null; __sm_rc=$?; fi
+printf '\\n__SM_STEP {index} %s %s\\n' "$__sm_rc" "$(( $(date +%s%N) - __sm_start ))"
+printf '\\n__SM_STEP_ERR {index}\\n' >&2
+[ "$__sm_rc" = 0 ] || [ "$__sm_rc" = skipped ] || exit $__sm_rc
+"""
+
+
+def is_batchable(task):
+    return 'command' in task and not task.get('concurrent') and task.get('batch', True)
+
+
+def batch_script(tasks):
+    # The script is sent inline (as a heredoc) so the batch costs a single
+    # command; it stops at the first failing step.
+    steps = [
+        BATCH_STEP.format(
+            index=index,
+            check='( {} ) </dev/null >/dev/null 2>&1'.format(task['check']) if isinstance(task.get('check'), str) else 'false',
+            command=task['command'],
+        )
+        for index, task in enumerate(tasks)
+    ]
+    return "bash <<'__SM_BATCH__'\n{}__SM_BATCH__".format(''.join(steps))
+
+
+def split_batch_output(output, marker):
+    # Returns {step index: (marker fields, output)}. With a pty stderr ends
+    # up in stdout too, so the other stream's markers are dropped.
+    steps = {}
+    lines = []
+
+    for line in output.splitlines():
+        if line.startswith(marker + ' '):
+            # Without the blank lines the markers are printed after.
+            fields = line.split()[1:]
+            steps[int(fields[0])] = (fields[1:], '\n'.join(lines).strip('\n'))
+            lines = []
+        elif not line.startswith('__SM_STEP'):
+            lines.append(line)
+
+    return steps
+
+
+def run_batch(tasks, skip_locally, user=None, report=None):
+    # Runs a run of consecutive small command tasks as one script. Returns
+    # {id(task): future} (None for skipped tasks) for the tasks which ran;
+    # anything after a failure is left for run_tasks to run normally. A step
+    # which didn't report back after the ones before it succeeded may have
+    # run, so it counts as failed rather than being run again.
+    batch = []
+    prepared = {}
+
+    for task in tasks:
+        if not is_batchable(task):
+            break
+
+        if skip_locally(task):
+            prepared[id(task)] = None
+        else:
+            batch.append(task)
+
+    # Not worth it for a single task, and it keeps any retries simple.
+    if len(batch) < 2:
+        return prepared
+
+    result = current_backend(fabric.api.env).run(batch_script(batch), user=user)
+    prepared.update(batch_results(batch, result, report=report))
+    return prepared
+
+
+def batched(step_result):
+    step_result.batched = True
+    return completed(lambda: step_result)
+
+
+def unreported_step(task, result):
+    stderr = [line for line in getattr(result, 'stderr', '').splitlines() if line and not line.startswith('__SM_STEP')]
+    return command_result(
+        '', '\n'.join(['The batch ended before this step reported back.'] + stderr[-5:]),
+        result.return_code or 1, task['command'],
+    )
+
+
+def batch_results(batch, result, report=None):
+    # Splits the result of a batch script into {id(task): future} (None for
+    # skipped steps).
+    stdout_steps = split_batch_output(str(result), '__SM_STEP')
+    stderr_steps = split_batch_output(getattr(result, 'stderr', ''), '__SM_STEP_ERR')
+    prepared = {}
+
+    for index, task in enumerate(batch):
+        if index not in stdout_steps:
+            # The step after a failure never ran, one after a success may have.
+            if index == 0 or stdout_steps[index - 1][0][0] in ('0', 'skipped'):
+                prepared[id(task)] = batched(unreported_step(task, result))
+            break
+
+        (return_code, nanoseconds), stdout = stdout_steps[index]
+
+        if return_code == 'skipped':
+            prepared[id(task)] = None
+            continue
+
+        if report:
+            stdout = '{}\n__SM_REMOTE_NS {}'.format(stdout, nanoseconds)
+
+        prepared[id(task)] = batched(command_result(
+            stdout, stderr_steps.get(index, ((), ''))[1], int(return_code), task['command'],
+        ))
+
+    return prepared
+
+
+def start_ahead(env, tasks, should_skip, skip_locally, user=None, report=None, batch=False):  # pylint: disable=too-many-arguments
+    # Starts the tasks from tasks[0] which can run ahead of being printed,
+    # returning {id(task): future} (None for skipped tasks).
+    task = tasks[0]
+
+    # With a concurrent backend, tasks marked `concurrent` are started
+    # together and their results collected (and printed) in order.
+    if task.get('concurrent') and current_backend(env).concurrent:
+        return start_concurrent(tasks, should_skip, user=user, report=report)
+
+    # With `batch`, small command tasks are run as a single script.
+    if batch and is_batchable(task):
+        return run_batch(tasks, skip_locally, user=user, report=report)
+
+    return {}
+
+
+def attempt_task(task, future, retries, user=None, report=None):
+    # Returns the (fabric) result of the task and the number of attempts. The
+    # first attempt may already be running as `future`.
+    attempts = 0
+
+    while True:
+        attempts += 1
+
+        if future:
+            task_result = future.result()
+            future = None
+        else:
+            task_result = execute_task(task, user=user, report=report)
+        output = '{}\n{}'.format(task_result, getattr(task_result, 'stderr', ''))
+
+        if task_result.succeeded or attempts > retries or not is_transient(task, output):
+            return task_result, attempts
+
+        # Back off: 2, 4, 8... seconds, capped at a minute.
+        time.sleep(min(2 ** attempts, 60))
+
+
+def record_result(task, task_result, started, attempts, report=None):
+    duration = time.monotonic() - started
+
+    # Batched tasks all finished before the first was printed.
+    if getattr(task_result, 'batched', False):
+        duration = measured_duration(task_result) or duration
+
+    result = TaskResult(
+        task['title'],
+        'succeeded' if task_result.succeeded else 'failed',
+        stdout=strip_timer(task_result) if isinstance(task_result, str) else '',
+        stderr=getattr(task_result, 'stderr', ''),
+        return_code=getattr(task_result, 'return_code', 0 if task_result.succeeded else None),
+        duration=duration,
+        attempts=attempts,
+    )
+
+    if report:
+        report.add(
+            task['title'],
+            duration,
+            state=result.state,
+            remote_duration=measured_duration(task_result) if 'command' in task else None,
+            transferred=transfer_size(task),
+        )
+
+    return result
+
+
+def record_skip(task, started, report=None):
+    title_print(task['title'], state='skipped')
+
+    if report:
+        report.add(task['title'], time.monotonic() - started, state='skipped')
+
+    return TaskResult(task['title'], 'skipped')
+
+
+def run_tasks(env, tasks, user=None, policy='fail-fast', batch=False):  # pylint: disable=too-many-locals
+    # Runs the tasks in order and returns a TaskResult for each one. With the
+    # 'fail-fast' and 'retry-<n>' policies the first failure raises TaskFailed
+    # (carrying the results so far); with 'continue' every task is attempted
+    # and the caller checks the results.
+    journal = env.get('task_journal')
+    report = env.get('run_report')
+    stop_on_failure, default_retries = parse_policy(policy)
+    results = []
+    running = {}
+
+    def completed_before(task):
+        return bool(journal) and journal.is_complete(task)
+
+    def should_skip(task):
+        return completed_before(task) or is_satisfied(task, user=user)
+
+    def skip_locally(task):
+        return completed_before(task) or (callable(task.get('check')) and task['check']())
+
+    # Loop tasks
+    for index, task in enumerate(tasks):
+        if id(task) not in running:
+            running.update(start_ahead(env, tasks[index:], should_skip, skip_locally, user=user, report=report, batch=batch))
+
+        started = time.monotonic()
+        future = running.pop(id(task), False)
+
+        if future is None or (future is False and should_skip(task)):
+            results.append(record_skip(task, started, report=report))
+            continue
+
+        title_print(task['title'], state='task')
+        task_result, attempts = attempt_task(task, future, task.get('retries', default_retries), user=user, report=report)
+        result = record_result(task, task_result, started, attempts, report=report)
+        results.append(result)
 
         # Check result
-        check_request(task, task_result)
+        title_print(task['title'], state=result.state)
+
+        if result.succeeded:
+            if journal:
+                journal.mark_complete(task)
+        elif stop_on_failure:
+            raise TaskFailed(results)
+
+    return results
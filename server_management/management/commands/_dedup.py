@@ -0,0 +1,116 @@
+"""Hash the files in a media folder, and put known content in place without
+transferring it.
+
+This file is uploaded to the server by pushmedia and run there with the system
+Python, so it must only use the standard library.
+
+    python3 _dedup.py hashes /var/www/example_media ~/.server-management-media.json
+    python3 _dedup.py link /var/www/example_media /tmp/plan.json
+"""
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+# Matches pushmedia's rsync `--exclude "cache/"` (thumbnails).
+EXCLUDE = ('cache',)
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(65536), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def find_files(root):
+    for folder, folders, filenames in os.walk(root):
+        folders[:] = [name for name in folders if name not in EXCLUDE]
+
+        for filename in filenames:
+            yield os.path.join(folder, filename)
+
+
+def hashes(root, manifest_path):
+    # Prints {relative path: sha1} for the folder. Sizes and mtimes are kept
+    # in the manifest so unchanged files aren't read again.
+    manifest_path = os.path.expanduser(manifest_path)
+
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        manifest = {}
+
+    updated = {}
+
+    for path in find_files(root):
+        stat = os.stat(path)
+        relative_path = os.path.relpath(path, root)
+        entry = manifest.get(relative_path)
+
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            updated[relative_path] = entry
+        else:
+            updated[relative_path] = [stat.st_size, stat.st_mtime_ns, file_hash(path)]
+
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as manifest_file:
+        json.dump(updated, manifest_file)
+
+    os.rename(manifest_path + '.tmp', manifest_path)
+
+    json.dump({path: entry[2] for path, entry in updated.items()}, sys.stdout)
+
+
+def materialise(source, destination, methods):
+    # Reflinks share blocks but are separate files; only some filesystems
+    # (btrfs, XFS) have them. Otherwise hardlink, or copy across devices.
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    temporary = destination + '.dedup-tmp'
+
+    if 'reflink' in methods:
+        if subprocess.run(['cp', '--reflink=always', source, temporary], stderr=subprocess.DEVNULL).returncode == 0:
+            os.replace(temporary, destination)
+            return 'reflink'
+
+        # Not supported here, don't try again (cp can leave an empty file).
+        methods.discard('reflink')
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+
+    try:
+        os.link(source, temporary)
+        method = 'hardlink'
+    except OSError:
+        shutil.copy2(source, temporary)
+        method = 'copy'
+
+    os.replace(temporary, destination)
+    return method
+
+
+def link(root, plan_path):
+    # The plan is a list of [existing path, new path] pairs.
+    with open(plan_path, 'r', encoding='utf-8') as plan_file:
+        plan = json.load(plan_file)
+
+    methods = {'reflink'}
+    counts = {}
+
+    for source, destination in plan:
+        method = materialise(os.path.join(root, source), os.path.join(root, destination), methods)
+        counts[method] = counts.get(method, 0) + 1
+
+    json.dump(counts, sys.stdout)
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'hashes':
+        hashes(sys.argv[2], sys.argv[3])
+    elif sys.argv[1] == 'link':
+        link(sys.argv[2], sys.argv[3])
@@ -0,0 +1,134 @@
+import json
+import os
+import time
+
+from django.conf import settings as django_settings
+from fabric.api import local, settings, sudo
+
+from ._backends import current_backend
+from ._core import get_cache_dir
+
+# Changes whenever anything is written to the database (DDL changes the
+# catalogs, so it counts too). The WAL insert position moves as soon as a
+# write is made, but it's shared by every database in the cluster, so writes
+# elsewhere (and checkpoints) change it too. That only costs an extra dump.
+# The write counters are kept alongside it, with the server's start time and
+# the last reset of the statistics as either resets them. Reading it doesn't
+# touch the data. The WAL functions were renamed in PostgreSQL 10.
+FINGERPRINT_SQL = (
+    'SELECT pg_postmaster_start_time(), {wal_position}, stats_reset, tup_inserted, tup_updated, tup_deleted '
+    'FROM pg_stat_database WHERE datname = current_database()'
+)
+WAL_POSITION_FUNCTIONS = ('pg_current_wal_insert_lsn()', 'pg_current_xlog_insert_location()')
+
+# Cached dumps which haven't been used for this long are deleted.
+DUMP_MAX_AGE_DAYS = 14
+
+
+def remote_fingerprint(env, remote):
+    # An empty string if it can't be read, which never matches.
+    # Tries the function names from PostgreSQL 10 first, then the older ones.
+    result = current_backend(env).run(
+        ' || '.join(
+            'psql -tAc "{}" {}'.format(FINGERPRINT_SQL.format(wal_position=function), remote['database']['name'])
+            for function in WAL_POSITION_FUNCTIONS
+        ),
+        user=remote['database']['user'],
+        quiet=True,
+    )
+    return str(result).strip() if result.succeeded else ''
+
+
+def download_dump(env, remote, destination):
+    with settings(warn_only=True):
+        # Dump the database on the server.
+        sudo("su - {user} -c 'pg_dump {name} -cOx -U {user} -f /home/{user}/{name}.sql --clean'".format(
+            name=remote['database']['name'],
+            user=remote['database']['user'],
+        ))
+
+        # Pull the SQL file down.
+        result = local('scp {} {}@{}:/home/{}/{}.sql {}'.format(
+            '' if not getattr(env, 'key_filename') else ' -i {} '.format(env.key_filename),
+            env.user,
+            env.host_string,
+            remote['database']['user'],
+            remote['database']['name'],
+            destination,
+        ))
+
+        # Delete the file on the server.
+        sudo('rm -f /home/{}/{}.sql'.format(
+            remote['database']['user'],
+            remote['database']['name'],
+        ))
+
+    return result.succeeded
+
+
+class DumpCache(object):
+    # The last dump of a remote database, kept with the fingerprint the
+    # database had when it was made.
+
+    def __init__(self, env, remote):
+        folder = get_cache_dir('dumps', env.host_string)
+        self.path = os.path.join(folder, '{}.sql'.format(remote['database']['name']))
+        self.record_path = os.path.join(folder, '{}.json'.format(remote['database']['name']))
+
+        try:
+            with open(self.record_path, 'r', encoding='utf-8') as record_file:
+                self.fingerprint = json.load(record_file)['fingerprint']
+        except (OSError, ValueError, KeyError):
+            self.fingerprint = None
+
+    def fresh(self, fingerprint):
+        return bool(fingerprint) and fingerprint == self.fingerprint and os.path.exists(self.path)
+
+    def record(self, fingerprint):
+        self.fingerprint = fingerprint
+
+        with open(self.record_path, 'w', encoding='utf-8') as record_file:
+            json.dump({'fingerprint': fingerprint}, record_file)
+
+
+def evict_dumps(max_age_days=None):
+    # Every remote database keeps one dump, drop the ones nobody has pulled
+    # for a while.
+    if max_age_days is None:
+        max_age_days = getattr(django_settings, 'SERVER_MANAGEMENT_DUMP_MAX_AGE_DAYS', DUMP_MAX_AGE_DAYS)
+
+    oldest = time.time() - max_age_days * 86400
+
+    for folder, _, names in os.walk(get_cache_dir('dumps')):
+        for name in names:
+            path = os.path.join(folder, name)
+
+            if os.path.getmtime(path) < oldest:
+                os.unlink(path)
+
+
+def cached_dump(env, remote, fingerprint=None, force=False):
+    # Returns the path of an up to date dump of the remote database, only
+    # dumping it again if it has changed since the cached one was made (or
+    # `force` is set).
+    cache = DumpCache(env, remote)
+
+    if fingerprint is None:
+        fingerprint = remote_fingerprint(env, remote)
+
+    if not force and cache.fresh(fingerprint):
+        print('The remote database has not changed, using the dump from the last time.')
+        os.utime(cache.path)
+        os.utime(cache.record_path)
+        return cache.path
+
+    # The fingerprint is taken before dumping, so anything written while the
+    # dump runs makes the next one differ.
+    cache.record(None)
+
+    if not download_dump(env, remote, cache.path):
+        return None
+
+    cache.record(fingerprint)
+    evict_dumps()
+    return cache.path
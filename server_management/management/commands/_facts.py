@@ -0,0 +1,80 @@
+from fabric.api import env, hide, run, settings, sudo
+
+# Keys which can appear more than once in the output of the facts script.
+LIST_FACTS = ('package', 'user', 'group', 'path', 'venv')
+
+FACTS_SCRIPT = r"""
+. /etc/os-release 2>/dev/null
+echo "os_id=$ID"
+echo "os_version=$VERSION_ID"
+echo "cpu_count=$(nproc)"
+awk '/^MemTotal:/ {{ print "memory_mb=" int($2 / 1024) }} /^SwapTotal:/ {{ print "swap_mb=" int($2 / 1024) }}' /proc/meminfo
+df -Pm / | awk 'NR == 2 {{ print "disk_mb=" $2; print "disk_free_mb=" $4 }}'
+echo "vfs_cache_pressure=$(cat /proc/sys/vm/vfs_cache_pressure)"
+echo "disk_rotational=$(lsblk -ndo ROTA "$(findmnt -no SOURCE /)" 2>/dev/null | head -n 1 | tr -d ' ')"
+echo "postgres_version=$(ls /etc/postgresql 2>/dev/null | sort -V | tail -n 1)"
+test -x /usr/bin/pypy && echo "pypy=1"
+dpkg-query -W -f='package=${{Package}} ${{db:Status-Abbrev}}\n' 2>/dev/null | awk '$2 ~ /^ii/ {{ print $1 }}'
+getent passwd | cut -d: -f1 | sed 's/^/user=/'
+getent group | cut -d: -f1 | sed 's/^/group=/'
+for path in {paths}; do test -e "$path" && echo "path=$path"; done
+if [ -n "{project}" ]; then
+    for venv in /var/www/{project}/.venv-*/bin/activate; do test -e "$venv" && echo "venv=${{venv%/bin/activate}}"; done
+    test -d /var/www/{project}/.git && echo "git_hash=$(cd /var/www/{project} && git -c safe.directory=/var/www/{project} rev-parse --short HEAD 2>/dev/null)"
+    test -f ~{project}/.ssh/id_rsa.pub && echo "ssh_key=$(cat ~{project}/.ssh/id_rsa.pub)"
+fi
+true
+"""
+
+
+def parse_facts(output):
+    facts = {key: [] for key in LIST_FACTS}
+
+    for line in output.splitlines():
+        if '=' not in line:
+            continue
+
+        key, value = line.strip().split('=', 1)
+
+        if key in LIST_FACTS:
+            facts[key].append(value)
+        else:
+            facts[key] = value
+
+    for key in ('cpu_count', 'memory_mb', 'swap_mb', 'disk_mb', 'disk_free_mb', 'disk_rotational'):
+        if key in facts:
+            facts[key] = int(facts[key] or 0)
+
+    facts['pypy'] = facts.get('pypy') == '1'
+
+    for key in LIST_FACTS:
+        facts[key] = set(facts[key])
+
+    return facts
+
+
+def gather_facts(project='', paths=(), refresh=False):
+    # Collect everything the commands want to know about the server in a
+    # single round-trip. The result is cached for the rest of the run, pass
+    # `refresh` after making changes which the facts cover.
+    cache = env.setdefault('server_facts', {})
+    cache_key = (env.host_string, project, tuple(paths))
+
+    if cache_key in cache and not refresh:
+        return cache[cache_key]
+
+    script = FACTS_SCRIPT.format(
+        project=project,
+        paths=' '.join("'{}'".format(path) for path in paths),
+    )
+
+    with hide('output', 'running', 'warnings'), settings(warn_only=True):
+        # Some of the facts (e.g. the application user's SSH key) aren't
+        # readable by the deploy user.
+        if env.user == 'root':
+            output = run(script)
+        else:
+            output = sudo(script, user='root')
+
+    cache[cache_key] = parse_facts(output)
+    return cache[cache_key]
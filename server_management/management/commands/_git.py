@@ -0,0 +1,87 @@
+import re
+
+# Shared bare mirrors live here, one per repository. They're group writable
+# by `webapps` so every application user can fetch into them.
+MIRROR_ROOT = '/var/cache/server-management/git'
+
+# Updates the checkout in the current folder to `{ref}` (a branch is used when
+# it's empty). Shallow checkouts stay shallow, and partial clones keep their
+# filter (git stores it with the remote). With a mirror (an alternates file),
+# the mirror is fetched first and the checkout fetches from it, so nothing
+# crosses the network twice. `{ref}` can be a tag, which a single branch clone
+# doesn't have locally, so the checkout is reset to FETCH_HEAD. Commits which
+# can't be fetched on their own (abbreviated hashes, or a server which doesn't
+# allow it) fall back to the full history of the branch (and its tags).
+FETCH_SCRIPT = r"""
+set -e
+branch=$(git symbolic-ref --short HEAD)
+source=origin
+mirror=$(sed -n 's#/objects$##p' .git/objects/info/alternates 2>/dev/null || true)
+if [ -n "$mirror" ]; then
+    git -C "$mirror" fetch --prune --quiet
+    source="$mirror"
+fi
+depth=
+test -f .git/shallow && depth=--depth=1
+ref="{ref}"
+if [ -z "$ref" ]; then
+    git fetch $depth "$source" "$branch"
+    git reset --hard FETCH_HEAD
+elif git fetch $depth "$source" "$ref" 2>/dev/null; then
+    git reset --hard FETCH_HEAD
+else
+    test -f .git/shallow && depth=--unshallow
+    git fetch $depth --tags "$source" "$branch"
+    git reset --hard "$ref"
+fi
+"""
+
+
+def git_options(server, url):
+    # Clone options for a server, from `git` in its config: `depth` (1 by
+    # default, 0 for the full history), `filter` (e.g. "blob:none" for a
+    # partial clone, git 2.19+) and `mirror` (true, or the path of a bare
+    # mirror to share between projects).
+    options = {'depth': 1, 'filter': None, 'mirror': None}
+    options.update(server.get('git') or {})
+
+    if options['mirror'] is True:
+        options['mirror'] = mirror_path(url)
+
+    return options
+
+
+def mirror_path(url):
+    # git@github.com:account/repo.git -> .../github.com/account/repo.git
+    address = re.sub(r'^[^@/]+@', '', re.sub(r'^\w+://', '', url))
+    host, _, path = address.replace(':', '/', 1).partition('/')
+    return '{}/{}/{}'.format(MIRROR_ROOT, host, path if path.endswith('.git') else path + '.git')
+
+
+def mirror_command(url, mirror):
+    # Creates or updates a bare mirror. Objects in it may be borrowed by
+    # checkouts which have no other copy, so git must never prune them.
+    return (
+        'if [ -d {mirror} ]; then git -C {mirror} fetch --prune --quiet; '
+        'else git clone --mirror --config core.sharedRepository=group --config gc.pruneExpire=never {url} {mirror}; fi'
+    ).format(url=url, mirror=mirror)
+
+
+def clone_command(url, branch, path, options):
+    # With a mirror the objects are already on the machine, so the checkout
+    # borrows them (alternates) rather than being shallow.
+    args = ['git', 'clone', '-b', branch]
+
+    if options['mirror']:
+        args += ['--reference', options['mirror']]
+    else:
+        if options['depth']:
+            args.append('--depth={}'.format(options['depth']))
+        if options['filter']:
+            args.append('--filter={}'.format(options['filter']))
+
+    return ' '.join(args + [url, path])
+
+
+def fetch_script(ref=None):
+    return FETCH_SCRIPT.format(ref=ref or '')
@@ -0,0 +1,99 @@
+USERLIST = '/etc/pgbouncer/userlist.txt'
+
+
+def postgres_reload_tasks():
+    # A reload applies most settings, the server reports any which only take
+    # effect on a restart.
+    return [
+        {
+            'title': 'Reload PostgreSQL',
+            'command': 'service postgresql reload',
+        },
+        {
+            # The reload is handled in the background, give it a moment.
+            'title': 'Restart PostgreSQL for settings which need it',
+            'command': 'service postgresql restart',
+            'check': 'sleep 1; test -z "$(su - postgres -c "psql -tAc \'SELECT name FROM pg_settings WHERE pending_restart\'")"',
+        },
+    ]
+
+
+def database_tasks(db_name, db_user):
+    return [
+        {
+            'title': 'Create the application postgres role',
+            'command': f'su - postgres -c "createuser {db_user}"',
+            'check': f'su - postgres -c "psql -tAc \\"SELECT 1 FROM pg_roles WHERE rolname = \'{db_user}\'\\"" | grep -q 1',
+        },
+        {
+            'title': 'Ensure database is created',
+            'command': f'su - postgres -c "createdb {db_name} --encoding=UTF-8 --locale=en_GB.UTF-8 --template=template0 --owner={db_user} --no-password"',
+            'check': f'su - postgres -c "psql -lqtA" | cut -d "|" -f 1 | grep -qx {db_name}',
+        },
+        {
+            'title': 'Ensure user has access to the database',
+            'command': f'su - postgres -c "psql {db_name} -c \'GRANT ALL ON DATABASE {db_name} TO {db_user}\'"',
+        },
+        {
+            'title': 'Ensure user does not have unnecessary privileges',
+            'command': f'su - postgres -c "psql {db_name} -c \'ALTER USER {db_user} WITH NOSUPERUSER NOCREATEDB\'"',
+        },
+    ]
+
+
+def pgbouncer_tasks(postgres_folder, db_name, db_user, restart=False):
+    # PgBouncer connects to PostgreSQL's socket as the postgres OS user, so
+    # peer authentication needs a map from it to the role. The role's own OS
+    # user stays in the map, for direct connections.
+    hba_line = f'local {db_name} {db_user} peer map=server_management_pgbouncer'
+    ident_lines = [
+        f'server_management_pgbouncer postgres {db_user}',
+        f'server_management_pgbouncer {db_user} {db_user}',
+    ]
+
+    tasks = [
+        {
+            'title': 'Let PgBouncer connect to PostgreSQL as the application role',
+            'command': '; '.join([
+                f"grep -qxF '{hba_line}' {postgres_folder}/pg_hba.conf || sed -i '1i {hba_line}' {postgres_folder}/pg_hba.conf",
+            ] + [
+                f"grep -qxF '{line}' {postgres_folder}/pg_ident.conf || echo '{line}' >> {postgres_folder}/pg_ident.conf"
+                for line in ident_lines
+            ] + [
+                'service postgresql reload',
+            ]),
+            'check': ' && '.join([
+                f"grep -qxF '{hba_line}' {postgres_folder}/pg_hba.conf",
+            ] + [
+                f"grep -qxF '{line}' {postgres_folder}/pg_ident.conf"
+                for line in ident_lines
+            ]),
+        },
+        {
+            # The auth file holds the role's name and password hash, taken
+            # from the database, and is only rewritten when it differs.
+            # PgBouncer may not be running yet on a new server, so this starts
+            # it rather than reloading it.
+            'title': 'Write the PgBouncer auth file',
+            'command': '; '.join([
+                f'su - postgres -c "psql -tAc \\"SELECT chr(34) || usename || chr(34) || \' \' || chr(34) || coalesce(passwd, \'\') || chr(34) FROM pg_shadow WHERE usename = \'{db_user}\'\\"" > {USERLIST}.new',
+                f'chown postgres:postgres {USERLIST}.new',
+                f'chmod 640 {USERLIST}.new',
+                f'cmp -s {USERLIST}.new {USERLIST} && rm {USERLIST}.new || {{ mv {USERLIST}.new {USERLIST}; systemctl reload-or-restart pgbouncer; }}',
+            ]),
+        },
+        {
+            'title': 'Enable PgBouncer',
+            'command': 'sed -i "s/^START=0/START=1/" /etc/default/pgbouncer; systemctl enable pgbouncer; service pgbouncer start',
+            'check': 'systemctl is-enabled -q pgbouncer && systemctl is-active -q pgbouncer',
+        },
+    ]
+
+    if restart:
+        # A new listen_port needs a restart, a reload covers the rest.
+        tasks.append({
+            'title': 'Restart PgBouncer',
+            'command': 'service pgbouncer restart',
+        })
+
+    return tasks
@@ -0,0 +1,117 @@
+"""Write .gz (and .br) siblings for the files in a static folder.
+
+This file is uploaded to the server and run there with the system Python, so
+it must only use the standard library. Brotli is used if either the Python
+module or the command line tool is available.
+
+    python3 _precompress.py /var/www/example_static
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+from multiprocessing import Pool
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = '.precompress.json'
+
+EXTENSIONS = (
+    '.css', '.js', '.map', '.json', '.svg', '.txt', '.xml', '.html', '.ico',
+    '.eot', '.otf', '.ttf',
+)
+
+MINIMUM_SIZE = 256
+
+BROTLI_BINARY = shutil.which('brotli')
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(65536), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def write_atomic(path, data):
+    with open(path + '.tmp', 'wb') as output:
+        output.write(data)
+
+    os.rename(path + '.tmp', path)
+
+
+def compress(path):
+    with open(path, 'rb') as source:
+        data = source.read()
+
+    # mtime=0 keeps the output stable for identical input.
+    write_atomic(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+
+    if brotli:
+        write_atomic(path + '.br', brotli.compress(data))
+    elif BROTLI_BINARY:
+        subprocess.run([BROTLI_BINARY, '-f', '-q', '11', '-o', path + '.br', path], check=True)
+
+    return path
+
+
+def find_files(root):
+    for folder, _, filenames in os.walk(root, followlinks=True):
+        for filename in filenames:
+            path = os.path.join(folder, filename)
+
+            if filename.endswith(EXTENSIONS) and os.path.getsize(path) >= MINIMUM_SIZE:
+                yield path
+
+
+def remove_orphans(root, sources):
+    # Compressed siblings of files which collectstatic no longer provides.
+    for folder, _, filenames in os.walk(root, followlinks=True):
+        for filename in filenames:
+            path = os.path.join(folder, filename)
+
+            if filename.endswith(('.gz', '.br')) and path[:-3] not in sources:
+                if path[:-3].endswith(EXTENSIONS):
+                    os.unlink(path)
+
+
+def main(root):
+    manifest_path = os.path.join(root, MANIFEST)
+
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        manifest = {}
+
+    sources = {path: file_hash(path) for path in find_files(root)}
+
+    changed = [
+        path for path, digest in sources.items()
+        if manifest.get(os.path.relpath(path, root)) != digest or not os.path.exists(path + '.gz')
+    ]
+
+    if changed:
+        with Pool(os.cpu_count()) as pool:
+            for _ in pool.imap_unordered(compress, changed, chunksize=8):
+                pass
+
+    remove_orphans(root, sources)
+
+    with open(manifest_path, 'w', encoding='utf-8') as manifest_file:
+        json.dump({os.path.relpath(path, root): digest for path, digest in sources.items()}, manifest_file)
+
+    print('Compressed {} of {} static files'.format(len(changed), len(sources)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
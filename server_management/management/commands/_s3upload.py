@@ -0,0 +1,203 @@
+"""Stream stdin to S3 (or anything which speaks its API) as a multipart upload,
+with several parts in flight at once.
+
+This file is uploaded to the server by backupdb and run there with the system
+Python, so it must only use the standard library. The job file holds the
+bucket, key and credentials, and is deleted as soon as it has been read.
+
+    { pg_dump example && touch /tmp/done; } | gzip | python3 _s3upload.py /tmp/job.json
+"""
+import datetime
+import hashlib
+import hmac
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+
+ATTEMPTS = 4
+
+
+def sign(key, message):
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256).digest()
+
+
+class S3(object):
+
+    def __init__(self, job):
+        self.endpoint = urllib.parse.urlsplit(job['endpoint'])
+        self.region = job.get('region') or 'us-east-1'
+        self.access_key = job['access_key_id']
+        self.secret_key = job['secret_access_key']
+        self.path = '/{}/{}'.format(job['bucket'], urllib.parse.quote(job['key'], safe='/~'))
+        self.local = threading.local()
+
+    def connection(self):
+        # One connection per thread, kept open between parts.
+        if getattr(self.local, 'connection', None) is None:
+            connection_class = http.client.HTTPSConnection if self.endpoint.scheme == 'https' else http.client.HTTPConnection
+            self.local.connection = connection_class(self.endpoint.netloc, timeout=120)
+        return self.local.connection
+
+    def signing_key(self, date):
+        key = sign(('AWS4' + self.secret_key).encode('utf-8'), date)
+        for part in (self.region, 's3', 'aws4_request'):
+            key = sign(key, part)
+        return key
+
+    def canonical_request(self, method, canonical_query, headers):
+        return '\n'.join([
+            method,
+            self.path,
+            canonical_query,
+            ''.join('{}:{}\n'.format(name, headers[name]) for name in sorted(headers)),
+            ';'.join(sorted(headers)),
+            headers['x-amz-content-sha256'],
+        ])
+
+    def headers(self, method, query, body):
+        # AWS Signature Version 4.
+        now = datetime.datetime.now(datetime.timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+
+        headers = {
+            'host': self.endpoint.netloc,
+            'x-amz-content-sha256': hashlib.sha256(body).hexdigest(),
+            'x-amz-date': amz_date,
+        }
+        canonical_query = '&'.join(
+            '{}={}'.format(urllib.parse.quote(name, safe='~'), urllib.parse.quote(value, safe='~'))
+            for name, value in sorted(query.items())
+        )
+
+        scope = '{}/{}/s3/aws4_request'.format(amz_date[:8], self.region)
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256',
+            amz_date,
+            scope,
+            hashlib.sha256(self.canonical_request(method, canonical_query, headers).encode('utf-8')).hexdigest(),
+        ])
+
+        headers['authorization'] = 'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}'.format(
+            self.access_key,
+            scope,
+            ';'.join(sorted(headers)),
+            hmac.new(self.signing_key(amz_date[:8]), string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest(),
+        )
+        return headers, canonical_query
+
+    def request(self, method, query, body=b''):
+        for attempt in range(ATTEMPTS):
+            headers, canonical_query = self.headers(method, query, body)
+            path = self.path + ('?' + canonical_query if canonical_query else '')
+
+            try:
+                connection = self.connection()
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                self.local.connection = None
+                error = str(e)
+            else:
+                if response.status < 300:
+                    return response, data
+                error = '{} {}'.format(response.status, data.decode('utf-8', 'replace'))
+
+                if response.status < 500 and response.status != 429:
+                    break
+
+            time.sleep(2 ** attempt)
+
+        raise IOError('{} {} failed: {}'.format(method, self.path, error))
+
+
+def find(data, name):
+    # The first element with this (namespaced) name.
+    for element in ElementTree.fromstring(data).iter():
+        if element.tag.split('}')[-1] == name:
+            return element.text
+    return None
+
+
+def upload_parts(s3, upload_id, source, part_size, concurrency):
+    # Returns the (number, etag) of each part, and the total size.
+    def upload_part(number, body):
+        response, _ = s3.request('PUT', {'partNumber': str(number), 'uploadId': upload_id}, body)
+        return number, response.getheader('ETag')
+
+    # No more than twice `concurrency` parts are held in memory, reading
+    # waits for uploads to finish.
+    slots = threading.BoundedSemaphore(concurrency * 2)
+    futures = []
+    size = 0
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            slots.acquire()
+            body = source.read(part_size)
+
+            if not body and futures:
+                slots.release()
+                break
+
+            size += len(body)
+            future = pool.submit(upload_part, len(futures) + 1, body)
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+
+            if len(body) < part_size:
+                break
+
+    return sorted(future.result() for future in futures), size
+
+
+def complete_upload(s3, upload_id, parts):
+    # Errors completing the upload can come back with a 200.
+    _, data = s3.request('POST', {'uploadId': upload_id}, ''.join(
+        ['<CompleteMultipartUpload>'] + [
+            '<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>'.format(number, etag)
+            for number, etag in parts
+        ] + ['</CompleteMultipartUpload>']
+    ).encode('utf-8'))
+
+    if find(data, 'Code'):
+        raise IOError('Completing the upload failed: {}'.format(data.decode('utf-8', 'replace')))
+
+
+def upload(job, source):
+    s3 = S3(job)
+
+    _, data = s3.request('POST', {'uploads': ''})
+    upload_id = find(data, 'UploadId')
+
+    try:
+        parts, size = upload_parts(
+            s3, upload_id, source, job.get('part_size', 16 * 1024 * 1024), job.get('concurrency', 4),
+        )
+
+        # The command writing to us creates this file once it has succeeded,
+        # before closing its output, so a failed dump isn't kept.
+        if job.get('complete_if'):
+            if not os.path.exists(job['complete_if']):
+                raise IOError('The input ended early, not completing the upload.')
+            os.unlink(job['complete_if'])
+    except BaseException:
+        s3.request('DELETE', {'uploadId': upload_id})
+        raise
+
+    complete_upload(s3, upload_id, parts)
+    return {'key': job['key'], 'size': size, 'parts': len(parts)}
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1], 'r', encoding='utf-8') as job_file:
+        upload_job = json.load(job_file)
+    os.unlink(sys.argv[1])
+
+    json.dump(upload(upload_job, sys.stdin.buffer), sys.stdout)
@@ -0,0 +1,126 @@
+import json
+import os
+import time
+
+from django.conf import settings as django_settings
+from fabric.api import hide, local, settings
+
+from ._core import get_cache_dir
+
+# Snapshots older than this are dropped, apart from the newest one of each
+# database.
+SNAPSHOT_MAX_AGE_DAYS = 14
+
+# And the oldest are dropped until they all fit in this much disk.
+SNAPSHOT_BUDGET_MB = 10240
+
+
+def local_query(sql, database='postgres'):
+    with hide('output', 'running', 'warnings'), settings(warn_only=True):
+        return local(f'psql -tAc "{sql}" {database}', capture=True).strip()
+
+
+def local_databases():
+    with hide('output', 'running', 'warnings'), settings(warn_only=True):
+        return set(local('psql -lqtA | cut -d "|" -f 1', capture=True).split())
+
+
+def copy_database(source, destination):
+    # createdb --template copies the files rather than replaying the SQL.
+    # From PostgreSQL 15 the default strategy writes the copy through the WAL,
+    # a plain file copy is quicker for anything of a decent size.
+    strategy = ''
+    if int(local_query('SHOW server_version_num') or 0) >= 150000:
+        strategy = ' --strategy=file_copy'
+
+    return local(f'createdb{strategy} --template={source} {destination}')
+
+
+class SnapshotStore(object):
+    # Local template databases made from pulled databases, so the working
+    # database can be put back without pulling again. The list lives in the
+    # cache's state folder.
+
+    def __init__(self):
+        self.path = os.path.join(get_cache_dir('state'), 'db-snapshots.json')
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as snapshots_file:
+                self.snapshots = json.load(snapshots_file)
+        except (OSError, ValueError):
+            self.snapshots = []
+
+    def save(self):
+        with open(self.path, 'w', encoding='utf-8') as snapshots_file:
+            json.dump(self.snapshots, snapshots_file, indent=2)
+
+    def forget_missing(self):
+        # Snapshots which have been dropped by hand.
+        existing = local_databases()
+        self.snapshots = [snapshot for snapshot in self.snapshots if snapshot['name'] in existing]
+        self.save()
+
+    def find(self, database, remote=None, name=None):
+        # Newest first.
+        return sorted(
+            (
+                snapshot for snapshot in self.snapshots
+                if snapshot['database'] == database
+                and (not remote or snapshot['remote'] == remote)
+                and (not name or snapshot['name'] == name)
+            ),
+            key=lambda snapshot: snapshot['created'],
+            reverse=True,
+        )
+
+    def take(self, database, remote):
+        name = '{}_snapshot_{}'.format(database, time.strftime('%Y%m%d%H%M%S'))
+
+        with settings(warn_only=True):
+            if copy_database(database, name).failed:
+                return None
+
+        self.snapshots.append({
+            'name': name,
+            'database': database,
+            'remote': remote,
+            'created': time.time(),
+            'size': int(local_query(f"SELECT pg_database_size('{name}')") or 0),
+        })
+        self.save()
+        return name
+
+    def restore(self, snapshot, database):
+        # Nothing may be connected to the working database (or the snapshot).
+        local(f'dropdb --if-exists {database}')
+        copy_database(snapshot['name'], database)
+
+    def evict(self, max_age_days=None, budget_mb=None):
+        if max_age_days is None:
+            max_age_days = getattr(django_settings, 'SERVER_MANAGEMENT_SNAPSHOT_MAX_AGE_DAYS', SNAPSHOT_MAX_AGE_DAYS)
+        if budget_mb is None:
+            budget_mb = getattr(django_settings, 'SERVER_MANAGEMENT_SNAPSHOT_BUDGET_MB', SNAPSHOT_BUDGET_MB)
+
+        oldest = time.time() - max_age_days * 86400
+        budget = budget_mb * 1024 * 1024
+        newest = {}
+        kept, evicted = [], []
+        used = 0
+
+        for snapshot in sorted(self.snapshots, key=lambda snapshot: snapshot['created'], reverse=True):
+            if snapshot['database'] not in newest:
+                newest[snapshot['database']] = snapshot
+            elif snapshot['created'] < oldest or used + snapshot['size'] > budget:
+                evicted.append(snapshot)
+                continue
+
+            used += snapshot['size']
+            kept.append(snapshot)
+
+        with hide('output', 'running', 'warnings'), settings(warn_only=True):
+            for snapshot in evicted:
+                local('dropdb --if-exists {}'.format(snapshot['name']))
+
+        self.snapshots = kept
+        self.save()
+        return evicted
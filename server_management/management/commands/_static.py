@@ -0,0 +1,25 @@
+from fabric.api import env
+
+from . import _precompress
+
+
+def precompress_tasks(static_root):
+    # Runs after collectstatic, so nginx can serve the .gz / .br siblings with
+    # gzip_static rather than compressing on every request. Files which
+    # haven't changed since the last run aren't compressed again.
+
+    # Named per connecting user, /tmp won't let one user replace another's file.
+    script = f'/tmp/server_management_precompress_{env.user}.py'
+
+    return [
+        {
+            'title': 'Upload the static compression script',
+            'fabric_command': 'put',
+            'fabric_args': [_precompress.__file__, script],
+            'fabric_kwargs': {'mode': 0o644},
+        },
+        {
+            'title': 'Precompress static files',
+            'command': f'python3 {script} {static_root}',
+        },
+    ]
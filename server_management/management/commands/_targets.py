@@ -0,0 +1,197 @@
+import io
+import json
+import os
+import shutil
+import time
+import uuid
+
+from django.core.management.base import CommandError
+from django.utils.timezone import now
+from fabric.api import env
+
+from . import _s3upload
+from ._backends import current_backend
+from ._core import get_cache_dir, title_print
+from ._dumps import cached_dump, remote_fingerprint
+
+
+class BackupTarget(object):
+    # Somewhere backups of a remote database are kept, set with `backup` in
+    # the remote's config. Backups are skipped when the database hasn't
+    # changed since the last one.
+
+    name = None
+
+    def __init__(self, options, config):
+        self.options = options
+        self.config = config
+
+    def last_fingerprint(self):
+        raise NotImplementedError
+
+    def store(self, remote, fingerprint, force=False):
+        # Returns a description of where the backup went.
+        raise NotImplementedError
+
+    def backup(self, remote, force=False):
+        # `force` always makes a backup from a fresh dump, for when the
+        # database is about to be replaced.
+        title = f'Back up the database to {self.name}'
+        title_print(title, state='task')
+        fingerprint = remote_fingerprint(env, remote)
+
+        if not force and fingerprint and fingerprint == self.last_fingerprint():
+            title_print(title, state='skipped')
+            print('The remote database has not changed since the last backup.')
+            return None
+
+        try:
+            location = self.store(remote, fingerprint, force=force)
+        except BaseException:
+            title_print(title, state='failed')
+            raise
+
+        title_print(title, state='succeeded')
+        print(f'Backed up to {location}')
+        return location
+
+
+class LocalTarget(BackupTarget):
+    # A folder on this machine, ~/Backups/<database>/<remote> by default. The
+    # dump pulldb made is reused if it's current.
+
+    name = 'local'
+
+    def __init__(self, options, config):
+        super(LocalTarget, self).__init__(options, config)
+        self.folder = os.path.expanduser(options.get('path') or '~/Backups/{}/{}'.format(
+            config['local']['database']['name'],
+            config['remote_name'],
+        ))
+        os.makedirs(self.folder, exist_ok=True)
+        self.fingerprint_path = os.path.join(self.folder, '.fingerprint')
+
+    def last_fingerprint(self):
+        if not any(name.endswith('.sql') for name in os.listdir(self.folder)):
+            return None
+
+        try:
+            with open(self.fingerprint_path, 'r', encoding='utf-8') as fingerprint_file:
+                return fingerprint_file.read()
+        except OSError:
+            return None
+
+    def store(self, remote, fingerprint, force=False):
+        dump_path = cached_dump(env, remote, fingerprint=fingerprint, force=force)
+
+        if not dump_path:
+            raise CommandError('Unable to dump the remote database.')
+
+        path = os.path.join(self.folder, '{}.sql'.format(now().strftime('%Y%m%d%H%M')))
+        shutil.copyfile(dump_path, path)
+
+        with open(self.fingerprint_path, 'w', encoding='utf-8') as fingerprint_file:
+            fingerprint_file.write(fingerprint)
+
+        return path
+
+
+class S3Target(BackupTarget):
+    # A bucket on S3 or anything compatible with it (MinIO, Spaces, B2...).
+    # The server streams the dump through gzip (pigz if it's installed)
+    # straight into a multipart upload, so it never touches this machine.
+
+    name = 's3'
+
+    def __init__(self, options, config):
+        super(S3Target, self).__init__(options, config)
+
+        for option in ('bucket', 'endpoint'):
+            if not options.get(option):
+                raise CommandError(f'The s3 backup target needs `{option}`.')
+
+        self.access_key_id = options.get('access_key_id') or os.environ.get('AWS_ACCESS_KEY_ID')
+        self.secret_access_key = options.get('secret_access_key') or os.environ.get('AWS_SECRET_ACCESS_KEY')
+
+        if not self.access_key_id or not self.secret_access_key:
+            raise CommandError('Set AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY for the s3 backup target.')
+
+        self.record_path = os.path.join(get_cache_dir('state'), '{}-{}-s3-backup.json'.format(
+            env.host_string,
+            config['remote_name'],
+        ))
+
+    def last_fingerprint(self):
+        try:
+            with open(self.record_path, 'r', encoding='utf-8') as record_file:
+                return json.load(record_file)['fingerprint']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def store(self, remote, fingerprint, force=False):
+        # Always a fresh dump, made on the server.
+        backend = current_backend(env)
+        key = '{}{}/{}-{}.sql.gz'.format(
+            self.options.get('prefix', ''),
+            self.config['remote_name'],
+            remote['database']['name'],
+            time.strftime('%Y%m%d%H%M%S'),
+        )
+
+        # The job holds the credentials, so it goes in a folder only we (and
+        # root, which runs the dump) can read.
+        folder = '/tmp/server_management_backup_{}'.format(uuid.uuid4().hex)
+        script = f'{folder}/_s3upload.py'
+        job = io.BytesIO(json.dumps({
+            'endpoint': self.options['endpoint'],
+            'region': self.options.get('region'),
+            'bucket': self.options['bucket'],
+            'key': key,
+            'access_key_id': self.access_key_id,
+            'secret_access_key': self.secret_access_key,
+            'part_size': self.options.get('part_size_mb', 16) * 1024 * 1024,
+            'concurrency': self.options.get('concurrency', 4),
+            'complete_if': f'{folder}/done',
+        }).encode('utf-8'))
+
+        backend.run(f'mkdir -m 700 {folder}', quiet=True)
+        backend.put(_s3upload.__file__, script)
+        backend.put(job, f'{folder}/job.json')
+
+        result = backend.run(
+            "{{ sudo -u {user} pg_dump {name} -cOx --clean && touch {folder}/done; }} "
+            "| $(command -v pigz || echo gzip) -c | python3 {script} {folder}/job.json; "
+            "__sm_rc=$?; rm -rf {folder}; exit $__sm_rc".format(
+                name=remote['database']['name'],
+                user=remote['database']['user'],
+                folder=folder,
+                script=script,
+            ),
+            user='root',
+            quiet=True,
+        )
+
+        if result.failed:
+            raise CommandError('The backup upload failed:\n{}'.format(result.stderr or result))
+
+        with open(self.record_path, 'w', encoding='utf-8') as record_file:
+            json.dump({'fingerprint': fingerprint, 'key': key}, record_file)
+
+        uploaded = json.loads(str(result).splitlines()[-1])
+        return 's3://{}/{} ({:,} bytes)'.format(self.options['bucket'], key, uploaded['size'])
+
+
+TARGETS = {
+    'local': LocalTarget,
+    's3': S3Target,
+}
+
+
+def get_target(config, remote, name=None):
+    options = dict(remote.get('backup') or {})
+    name = name or options.get('target', 'local')
+
+    if name not in TARGETS:
+        raise CommandError('Unknown backup target `{}`, use one of: {}.'.format(name, ', '.join(TARGETS)))
+
+    return TARGETS[name](options, config)
@@ -0,0 +1,179 @@
+def clamp(value, lower, upper):
+    return max(lower, min(upper, value))
+
+
+def service_tuning(facts, overrides=None):
+    # Size the application stack from the server's resources. The defaults are
+    # roughly what we used to hard-code for a 1GB / 1 core droplet, and any
+    # value can be overridden with `tuning` in the server's config.
+    cores = facts.get('cpu_count') or 1
+    memory_mb = facts.get('memory_mb') or 1024
+
+    # Gunicorn's usual recommendation is (2 x cores) + 1, but each worker is a
+    # full copy of the application so we also keep them to about half of the
+    # memory, assuming ~150MB per worker.
+    gunicorn_workers = clamp(min(2 * cores + 1, memory_mb // 2 // 150), 2, 33)
+
+    tuning = {
+        'gunicorn_workers': gunicorn_workers,
+        'gunicorn_threads': 2 if memory_mb < 2048 else 4,
+
+        # Memcached gets 1/16th of the memory, within reason.
+        'memcached_memory': clamp(memory_mb // 16, 64, 2048),
+        'memcached_connections': clamp(512 * cores, 1024, 8192),
+        'memcached_threads': clamp(cores, 4, 16),
+
+        'nginx_worker_processes': cores,
+        'nginx_worker_connections': clamp(1024 * cores, 1024, 8192),
+    }
+
+    tuning.update(overrides or {})
+    return tuning
+
+
+def kernel_tuning(facts, overrides=None):
+    # Swap, sysctls and file descriptor limits for a busy Nginx / Gunicorn
+    # host. `swap_mb` and `nofile` can be overridden with `kernel` in the
+    # server's config, and anything in its `sysctl` is added to (or replaces)
+    # the settings below.
+    overrides = dict(overrides or {})
+    memory_mb = facts.get('memory_mb') or 1024
+    disk_mb = facts.get('disk_mb') or 0
+
+    # Swap as large as the memory on small servers and half of it on larger
+    # ones, up to 8GB, but never more than a tenth of the disk.
+    swap_mb = memory_mb if memory_mb <= 2048 else max(2048, memory_mb // 2)
+    swap_mb = min(swap_mb, 8192, disk_mb // 10) if disk_mb else min(swap_mb, 4096)
+
+    nofile = overrides.pop('nofile', 65536)
+
+    sysctl = {
+        'vm.swappiness': 10,
+        'vm.vfs_cache_pressure': 50,
+
+        # Longer accept queues, so bursts of connections aren't dropped
+        # before Nginx or Gunicorn get to them.
+        'net.core.somaxconn': 4096 if memory_mb >= 1024 else 1024,
+        'net.core.netdev_max_backlog': 4096,
+        'net.ipv4.tcp_max_syn_backlog': 4096,
+
+        # Nginx makes a lot of short connections to Gunicorn.
+        'net.ipv4.tcp_tw_reuse': 1,
+        'net.ipv4.tcp_fin_timeout': 15,
+        # Starting above 12000 keeps outgoing connections off the ports our
+        # own services listen on (PostgreSQL 5432, PgBouncer 6432, Memcached
+        # 11211).
+        'net.ipv4.ip_local_port_range': '12000 65000',
+    }
+    sysctl.update(overrides.pop('sysctl', {}))
+
+    return {
+        'swap_mb': overrides.pop('swap_mb', swap_mb),
+        'nofile': nofile,
+        'sysctl': sorted(sysctl.items()),
+    }
+
+
+# Whether the running supervisord (and so the application) already has the
+# open file limit from `minfds`, which it only reads when it starts.
+SUPERVISOR_NOFILE_CHECK = (
+    'test "$(awk \'/Max open files/ {{print $4}}\' /proc/$(cat /var/run/supervisord.pid)/limits)" -ge {nofile}'
+)
+
+
+def postgres_tuning(facts, version, overrides=None):
+    # PostgreSQL settings for the server's memory, cores and disk. It shares
+    # the machine with the application, so it gets less of the memory than a
+    # dedicated database server would. Anything in `tuning` in the database's
+    # config is added to (or replaces) these, and `disk` ("ssd" or "hdd")
+    # overrides what the server reports.
+    overrides = dict(overrides or {})
+    memory_mb = facts.get('memory_mb') or 1024
+    disk_mb = facts.get('disk_mb') or 0
+    cores = facts.get('cpu_count') or 1
+    ssd = overrides.pop('disk', 'hdd' if facts.get('disk_rotational') else 'ssd') == 'ssd'
+    major = float(version or 0)
+
+    max_connections = overrides.get('max_connections', 100)
+    shared_buffers = clamp(memory_mb // 5, 128, 8192)
+    max_wal_size = clamp(disk_mb // 20, 1024, 16384) if disk_mb else 1024
+
+    settings = {
+        'max_connections': max_connections,
+        'shared_buffers': f'{shared_buffers}MB',
+        'effective_cache_size': '{}MB'.format(clamp(memory_mb // 2, 256, 65536)),
+        'maintenance_work_mem': '{}MB'.format(clamp(memory_mb // 16, 64, 2048)),
+        'work_mem': '{}MB'.format(clamp((memory_mb - shared_buffers) // (int(max_connections) * 3), 4, 64)),
+        'checkpoint_completion_target': 0.9,
+        'random_page_cost': 1.1 if ssd else 4,
+        'effective_io_concurrency': 200 if ssd else 2,
+        'max_worker_processes': max(8, cores),
+    }
+
+    # Settings which older versions don't know about, and refuse to start
+    # with.
+    if major >= 9.5:
+        settings['min_wal_size'] = '{}MB'.format(max_wal_size // 4)
+        settings['max_wal_size'] = f'{max_wal_size}MB'
+    if major >= 9.6:
+        settings['max_parallel_workers_per_gather'] = clamp(cores // 2, 1, 4)
+    if major >= 10:
+        settings['max_parallel_workers'] = cores
+    if major >= 11:
+        settings['max_parallel_maintenance_workers'] = clamp(cores // 2, 1, 4)
+
+    settings.update(overrides)
+
+    return sorted(settings.items())
+
+
+PGBOUNCER_DEFAULTS = {
+    # 'session' hands the server connection back once the client disconnects,
+    # 'transaction' after every transaction (which needs Django's
+    # DISABLE_SERVER_SIDE_CURSORS, and loses session state like SET).
+    'pool_mode': 'session',
+    'port': 6432,
+    'max_client_conn': 500,
+    'reserve_pool_size': 5,
+    # By default PgBouncer only listens on its Unix socket and checks the
+    # client's OS user (peer) through its own pg_hba.conf, as PostgreSQL does.
+    # Set `listen_addr` and use md5 or scram-sha-256 for logins over TCP,
+    # which need the role to have a password.
+    'auth_type': 'hba',
+    'listen_addr': '',
+    # Point the application at PgBouncer through PGPORT.
+    'app': True,
+}
+
+
+def pgbouncer_options(facts, overrides=None):
+    # None unless `pgbouncer` is set in the database's config, either to true
+    # or to any of the options above (plus `default_pool_size`).
+    if not overrides:
+        return None
+
+    cores = facts.get('cpu_count') or 1
+    return dict(
+        PGBOUNCER_DEFAULTS,
+        default_pool_size=clamp(2 * cores + 2, 10, 50),
+        **(overrides if isinstance(overrides, dict) else {})
+    )
+
+
+NGINX_DEFAULTS = {
+    # 'default' keeps the original config, 'performance' switches on the
+    # tuned variant (upstream keepalive, gzip_static, open_file_cache, ...).
+    'mode': 'default',
+    'keepalive': 16,
+    'brotli': False,  # Needs the ngx_brotli module.
+    'proxy_cache': False,
+    'proxy_cache_key': '$scheme$request_method$host$request_uri',
+    'proxy_cache_ttl': '10m',
+    'proxy_cache_size': '256m',
+}
+
+
+def nginx_options(overrides=None):
+    options = dict(NGINX_DEFAULTS, **(overrides or {}))
+    options['performance'] = options['mode'] == 'performance'
+    return options
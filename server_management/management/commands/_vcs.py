@@ -0,0 +1,176 @@
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# (connect, read) timeouts in seconds.
+TIMEOUT = (5, 30)
+
+# Responses which are worth another go. Anything else is returned (or raised)
+# straight away.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Requests which can't change anything twice. The others are only retried when
+# the server tells us it didn't handle them (429 / 503) or we never connected.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+def retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date. Returns 0 if
+    # it's missing or can't be read.
+    if not value:
+        return 0
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0
+
+
+def key_material(key):
+    # "ssh-rsa AAAA... user@host" -> "ssh-rsa AAAA...", the APIs drop comments.
+    return ' '.join(key.split()[:2])
+
+
+class APIClient(object):
+    # A requests.Session with a connection pool shared by every call (and
+    # every thread), timeouts, and retries with exponential backoff.
+
+    base_url = ''
+
+    def __init__(self, base_url=None, retries=3, backoff=0.5):
+        self.base_url = base_url or self.base_url
+        self.retries = retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, path, **kwargs):
+        url = path if path.startswith(('http://', 'https://')) else self.base_url + path
+        kwargs.setdefault('timeout', TIMEOUT)
+
+        for attempt in range(self.retries + 1):
+            final = attempt == self.retries
+            delay = self.backoff * 2 ** attempt
+
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.ConnectTimeout:
+                # It never reached the server, so it's always safe to repeat.
+                if final:
+                    raise
+            except (requests.ConnectionError, requests.Timeout):
+                if final or method not in IDEMPOTENT_METHODS:
+                    raise
+            else:
+                retryable = response.status_code in (429, 503) or (
+                    response.status_code in RETRY_STATUSES and method in IDEMPOTENT_METHODS
+                )
+
+                if final or not retryable:
+                    response.raise_for_status()
+                    return response
+
+                delay = max(delay, retry_after(response.headers.get('Retry-After')))
+
+            time.sleep(delay)
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def paginate(self, path, **kwargs):
+        # GitHub style pagination, through the Link header.
+        while path:
+            response = self.get(path, **kwargs)
+            yield from response.json()
+            path = response.links.get('next', {}).get('url')
+            kwargs.pop('params', None)
+
+
+class GitHub(APIClient):
+
+    base_url = 'https://api.github.com'
+
+    def __init__(self, token, **kwargs):
+        super(GitHub, self).__init__(**kwargs)
+        self.session.headers.update({
+            'Authorization': f'token {token}',
+            'Accept': 'application/vnd.github.v3+json',
+        })
+
+    def has_deploy_key(self, account, repo, key):
+        return any(
+            key_material(deploy_key['key']) == key_material(key)
+            for deploy_key in self.paginate(f'/repos/{account}/{repo}/keys', params={'per_page': 100})
+        )
+
+    def add_deploy_key(self, account, repo, title, key):
+        # Returns False if the repository has the key already.
+        if self.has_deploy_key(account, repo, key):
+            return False
+
+        self.post(f'/repos/{account}/{repo}/keys', json={
+            'title': title,
+            'key': key,
+            'read_only': True,
+        })
+        return True
+
+
+class Bitbucket(APIClient):
+
+    base_url = 'https://bitbucket.org/api/1.0'
+
+    def __init__(self, username, password, **kwargs):
+        super(Bitbucket, self).__init__(**kwargs)
+        self.session.auth = (username, password)
+
+    def has_deploy_key(self, account, repo, key):
+        response = self.get(f'/repositories/{account}/{repo}/deploy-keys/')
+        return key_material(key) in response.text
+
+    def add_deploy_key(self, account, repo, title, key):
+        if self.has_deploy_key(account, repo, key):
+            return False
+
+        self.post(f'/repositories/{account}/{repo}/deploy-keys/', data={'label': title, 'key': key})
+        return True
+
+
+class CircleCI(APIClient):
+
+    base_url = 'https://circleci.com/api/v1.1'
+
+    def __init__(self, token, **kwargs):
+        super(CircleCI, self).__init__(**kwargs)
+        self.session.params = {'circle-token': token}
+
+    def follow(self, account, repo):
+        # Following a project which is already followed does nothing.
+        return self.post(f'/project/github/{account}/{repo}/follow')
+
+    def has_ssh_key(self, account, repo, hostname):
+        settings = self.get(f'/project/github/{account}/{repo}/settings').json()
+        return any(ssh_key.get('hostname') == hostname for ssh_key in settings.get('ssh_keys') or [])
+
+    def add_ssh_key(self, account, repo, hostname, private_key):
+        if self.has_ssh_key(account, repo, hostname):
+            return False
+
+        self.post(f'/project/github/{account}/{repo}/ssh-key', json={
+            'hostname': hostname,
+            'private_key': private_key,
+        })
+        return True
@@ -1,44 +1,31 @@
-from django.utils.timezone import now
-from fabric.api import local, settings, sudo
-
 from ._core import ServerManagementBaseCommand, load_config
+from ._targets import TARGETS, get_target
 
 
-def perform_backup(env, config, remote):
-    with settings(warn_only=True):
-        # Dump the database on the server.
-        sudo('su - {user} -c \'pg_dump {name} -cOx -U {user} -f /home/{user}/{name}.sql --clean\''.format(
-            name=remote['database']['name'],
-            user=remote['database']['user'],
-        ))
-
-        backup_folder = '~/Backups/{}/{}'.format(
-            config['local']['database']['name'],
-            config['remote_name'],
-        )
+def perform_backup(env, config, remote, target=None, force=False):  # pylint: disable=unused-argument
+    return get_target(config, remote, target).backup(remote, force=force)
 
-        # Create a backups folder
-        local('mkdir -p {}'.format(backup_folder))
 
-        # Pull the SQL file down.
-        local('scp {} {}@{}:/home/{}/{}.sql {}/{}.sql'.format(
-            '' if not getattr(env, 'key_filename') else ' -i {} '.format(env.key_filename),
-            env.user,
-            env.host_string,
-            remote['database']['user'],
-            remote['database']['name'],
-            backup_folder,
-            now().strftime('%Y%m%d%H%M'),
-        ))
+class Command(ServerManagementBaseCommand):
 
-        # Delete the file on the server.
-        sudo('rm /home/{}/{}.sql'.format(
-            remote['database']['user'],
-            remote['database']['name'],
-        ))
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
 
+        parser.add_argument(
+            '--target',
+            dest='target',
+            default=None,
+            choices=sorted(TARGETS),
+            help="Where to keep the backup, the remote's `backup` target (or local) by default.",
+        )
 
-class Command(ServerManagementBaseCommand):
+        parser.add_argument(
+            '--force',
+            dest='force',
+            action='store_true',
+            default=False,
+            help='Make a backup from a fresh dump, even if the database looks unchanged.',
+        )
 
     def handle(self, *args, **options):
         from fabric.api import env
@@ -46,4 +33,4 @@ class Command(ServerManagementBaseCommand):
         # Load server config from project
         config, remote = load_config(env, options.get('remote', ''), debug=options.get('debug', False))
 
-        perform_backup(env, config, remote)
+        perform_backup(env, config, remote, options['target'], force=options['force'])
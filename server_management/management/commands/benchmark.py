@@ -0,0 +1,309 @@
+import atexit
+import glob
+import importlib
+import json
+import os
+import pkgutil
+import shutil
+import statistics
+import tempfile
+import time
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test.utils import override_settings
+from fabric.api import env
+from fabric.colors import green, red
+
+import server_management.management.commands
+
+from ._benchmark import FakeFabric, ThrowawayPostgres, empty_folder, make_media
+from ._core import ServerManagementBaseCommand, get_cache_dir
+
+PROJECT = 'benchmark'
+
+COMMAND_OPTIONS = {
+    'update': {'force_update': True},
+}
+
+SIZES = {
+    'small': {'rows': 10000, 'files': 100, 'file_size': 20 * 1024},
+    'medium': {'rows': 200000, 'files': 1000, 'file_size': 50 * 1024},
+    'large': {'rows': 2000000, 'files': 5000, 'file_size': 100 * 1024},
+}
+
+# What the fake server reports when facts are gathered.
+FACTS = '\n'.join([
+    'os_id=ubuntu',
+    'os_version=16.04',
+    'cpu_count=2',
+    'memory_mb=2048',
+    'git_hash=abc1234',
+    f'venv=/var/www/{PROJECT}/.venv-0000000',
+])
+
+
+class Command(ServerManagementBaseCommand):
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+
+        parser.add_argument(
+            '--commands',
+            dest='commands',
+            default='pulldb,pullmedia,pushmedia,update',
+            help='Comma separated list of the commands to benchmark.',
+        )
+
+        parser.add_argument(
+            '--sizes',
+            dest='sizes',
+            default='small',
+            help='Comma separated list of data sizes ({}).'.format(', '.join(SIZES)),
+        )
+
+        parser.add_argument(
+            '--rtts',
+            dest='rtts',
+            default='0,50,100',
+            help='Comma separated list of simulated round-trip times, in milliseconds.',
+        )
+
+        parser.add_argument(
+            '--repeat',
+            dest='repeat',
+            type=int,
+            default=3,
+            help='Runs per case, the median is reported.',
+        )
+
+        parser.add_argument(
+            '--baseline',
+            dest='baseline',
+            default=None,
+            help='Baseline file to compare against (defaults to the local cache).',
+        )
+
+        parser.add_argument(
+            '--save-baseline',
+            dest='save_baseline',
+            action='store_true',
+            default=False,
+            help='Store these results as the new baseline.',
+        )
+
+        parser.add_argument(
+            '--tolerance',
+            dest='tolerance',
+            type=float,
+            default=0.25,
+            help='Fail if a case is this much slower (as a fraction) than the baseline.',
+        )
+
+    def handle(self, *args, **options):
+        baseline_path = options['baseline'] or os.path.join(get_cache_dir('benchmarks'), 'baseline.json')
+        commands = options['commands'].split(',')
+        sizes = options['sizes'].split(',')
+        rtts = [int(rtt) for rtt in options['rtts'].split(',')]
+
+        for size in sizes:
+            if size not in SIZES:
+                raise CommandError(f'Unknown size `{size}`.')
+
+        # The fake has to replace fabric's functions wherever they've already
+        # been imported, so import every command first.
+        for module in pkgutil.iter_modules(server_management.management.commands.__path__):
+            importlib.import_module(f'server_management.management.commands.{module.name}')
+
+        sandbox = tempfile.mkdtemp(prefix='server-management-benchmark-')
+        results = {}
+
+        try:
+            for size in sizes:
+                results.update(self.run_size(sandbox, commands, size, rtts, options['repeat']))
+        finally:
+            shutil.rmtree(sandbox, ignore_errors=True)
+
+        self.report(results, baseline_path, options['tolerance'])
+
+        if options['save_baseline']:
+            with open(baseline_path, 'w', encoding='utf-8') as baseline_file:
+                json.dump(results, baseline_file, indent=2, sort_keys=True)
+            print(f'Baseline saved to {baseline_path}')
+
+    @staticmethod
+    def make_sandbox(root, spec):
+        paths = {
+            'root': root,
+            'site': os.path.join(root, 'site'),
+            'remote': os.path.join(root, 'remote'),
+            'media': os.path.join(root, 'media'),
+            'static': os.path.join(root, 'static'),
+            'cache': os.path.join(root, 'cache'),
+            'remote_media': os.path.join(root, 'remote', 'var', 'www', f'{PROJECT}_media'),
+        }
+
+        for path in (paths['site'], paths['media'], paths['static'], paths['remote_media'], os.path.join(root, 'home')):
+            os.makedirs(path, exist_ok=True)
+
+        os.makedirs(os.path.join(paths['site'], PROJECT), exist_ok=True)
+        open(os.path.join(paths['site'], PROJECT, 'wsgi.py'), 'w', encoding='utf-8').close()
+
+        for folder in ('home/benchmark_user', f'var/www/{PROJECT}_static', f'var/www/{PROJECT}', 'tmp', 'etc/supervisor'):
+            os.makedirs(os.path.join(paths['remote'], folder), exist_ok=True)
+
+        with open(os.path.join(paths['site'], 'server.json'), 'w', encoding='utf-8') as config_file:
+            json.dump({
+                'local': {'database': {'name': 'benchmark_local'}},
+                'remotes': {
+                    'benchmark': {
+                        'server': {'ip': 'benchmark.invalid', 'deploy_user': 'deploy', 'build_system': 'none'},
+                        'database': {'name': 'benchmark_remote', 'user': 'benchmark_user'},
+                        'is_aws': False,
+                    },
+                },
+            }, config_file)
+
+        make_media(paths['remote_media'], spec['files'], spec['file_size'])
+        make_media(paths['media'], spec['files'], spec['file_size'])
+        return paths
+
+    @staticmethod
+    def available_commands(commands):
+        if 'pulldb' in commands and not ThrowawayPostgres.available():
+            print('PostgreSQL binaries not found, skipping pulldb.')
+            commands = [command for command in commands if command != 'pulldb']
+
+        if not shutil.which('rsync'):
+            print('rsync not found, skipping the media commands.')
+            commands = [command for command in commands if command not in ('pullmedia', 'pushmedia')]
+
+        return commands
+
+    # Everything which happens before each run of a command, so every run
+    # does the same work.
+    @staticmethod
+    def reset_pullmedia(paths):
+        empty_folder(paths['media'])
+
+    @staticmethod
+    def reset_pushmedia(paths):
+        empty_folder(paths['remote_media'])
+
+    @staticmethod
+    def reset_update(paths):
+        # The record of the uploaded configs goes with them, otherwise only
+        # the first run would upload the Supervisor config.
+        empty_folder(os.path.join(paths['remote'], 'etc', 'supervisor'))
+
+        for record in glob.glob(os.path.join(paths['cache'], 'state', '*-configs.json')):
+            os.unlink(record)
+
+    @staticmethod
+    def reset_pulldb(paths):
+        shutil.rmtree(os.path.join(paths['cache'], 'dumps'), ignore_errors=True)
+
+    def time_command(self, fake, command, paths, repeat):
+        reset = getattr(self, f'reset_{command}', None)
+        timings = []
+
+        for _ in range(repeat):
+            if reset:
+                reset(paths)
+
+            # Each run should start from a clean env.
+            env.pop('server_facts', None)
+            env.pop('run_report', None)
+            fake.round_trips = 0
+
+            started = time.perf_counter()
+            call_command(command, remote='benchmark', **COMMAND_OPTIONS.get(command, {}))
+            timings.append(time.perf_counter() - started)
+
+            # Don't add benchmark runs to the real history.
+            if env.get('run_report'):
+                atexit.unregister(env.run_report.save)
+
+        return {
+            'seconds': round(statistics.median(timings), 3),
+            'round_trips': fake.round_trips,
+        }
+
+    def run_size(self, sandbox, commands, size, rtts, repeat):
+        spec = SIZES[size]
+        paths = self.make_sandbox(os.path.join(sandbox, size), spec)
+        commands = self.available_commands(commands)
+
+        postgres = None
+        if 'pulldb' in commands:
+            postgres = ThrowawayPostgres(os.path.join(paths['root'], 'postgres'))
+            postgres.start()
+            postgres.create_database('benchmark_remote', 'benchmark_user', spec['rows'])
+
+        # Everything the commands do locally (~, the cache, postgres) is
+        # pointed at the sandbox.
+        environ = dict(os.environ)
+        os.environ['HOME'] = os.path.join(paths['root'], 'home')
+        if postgres:
+            os.environ['PGHOST'] = postgres.socket
+
+        results = {}
+
+        try:
+            with override_settings(
+                SITE_ROOT=paths['site'],
+                MEDIA_ROOT=paths['media'],
+                STATIC_ROOT=paths['static'],
+                SERVER_MANAGEMENT_CACHE_DIR=paths['cache'],
+                DEBUG=False,
+            ):
+                for rtt in rtts:
+                    fake = FakeFabric(paths['remote'], rtt=rtt / 1000, facts=FACTS)
+                    fake.install()
+
+                    try:
+                        for command in commands:
+                            results[f'{command}/{size}/{rtt}ms'] = self.time_command(fake, command, paths, repeat)
+                    finally:
+                        fake.uninstall()
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+            if postgres:
+                postgres.stop()
+
+        return results
+
+    @staticmethod
+    def report(results, baseline_path, tolerance):
+        baseline = {}
+
+        if os.path.exists(baseline_path):
+            with open(baseline_path, 'r', encoding='utf-8') as baseline_file:
+                baseline = json.load(baseline_file)
+
+        regressions = []
+
+        print('')
+        print('{:<32} {:>10} {:>12} {:>10}'.format('case', 'seconds', 'round-trips', 'baseline'))
+
+        for case, result in sorted(results.items()):
+            previous = baseline.get(case)
+            comparison = ''
+
+            if previous:
+                change = (result['seconds'] - previous['seconds']) / max(previous['seconds'], 0.001)
+                comparison = '{:+.0%}'.format(change)
+
+                # Ignore tiny differences, they're noise at low latencies.
+                if change > tolerance and result['seconds'] - previous['seconds'] > 0.05:
+                    regressions.append(case)
+                    comparison = red(comparison)
+                else:
+                    comparison = green(comparison)
+
+            print('{:<32} {:>10.3f} {:>12} {:>10}'.format(case, result['seconds'], result['round_trips'], comparison))
+
+        if regressions:
+            raise CommandError('Slower than the baseline: {}'.format(', '.join(regressions)))
@@ -3,20 +3,39 @@ from __future__ import print_function
 import os
 import re
 from getpass import getpass
-from urllib.parse import urlencode
 
-import requests
 from django.conf import settings as django_settings
-from django.core.files.temp import NamedTemporaryFile
 from django.template.loader import render_to_string
 from fabric.api import abort, env, hide, lcd, local, prompt, run, settings
 
-from ._core import (ServerManagementBaseCommand, load_config, run_tasks,
-                    title_print)
+from ._apt import apt_tasks
+from ._artifacts import DHPARAM, ArtifactCache
+from ._backends import current_backend
+from ._configs import ConfigFile, configs_applied, upload_configs
+from ._core import (ServerManagementBaseCommand, TaskJournal, load_config,
+                    report_step, run_tasks, start_report, title_print)
+from ._facts import gather_facts
+from ._git import clone_command, git_options, mirror_command
+from ._postgres import database_tasks, pgbouncer_tasks, postgres_reload_tasks
+from ._static import precompress_tasks
+from ._tuning import (SUPERVISOR_NOFILE_CHECK, kernel_tuning, nginx_options,
+                      pgbouncer_options, postgres_tuning, service_tuning)
+from ._vcs import Bitbucket, CircleCI, GitHub
 
 
 class Command(ServerManagementBaseCommand):
 
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            dest='resume',
+            default=False,
+            help='Skip the tasks which completed during the previous deploy to this host.',
+        )
+
     # This is a complicated method which is vastly overloaded.  To improve it in
     # the future we could look to moving each individual block of actions into
     # either their own methods, or into their own files, which are then registered
@@ -26,6 +45,16 @@ class Command(ServerManagementBaseCommand):
         # Load server config from project
         config, remote = load_config(env, options.get('remote', ''), config_user='root', debug=options.get('debug', False))
 
+        start_report(env, 'deploy')
+
+        # Keep track of completed tasks so a failed deploy can be resumed.
+        env.task_journal = TaskJournal('deploy', env.host_string, resume=options.get('resume', False))
+
+        # Start generating the slow artifacts now, they'll be ready (or nearly)
+        # by the time we need to upload them.
+        artifacts = ArtifactCache()
+        artifacts.prepare(DHPARAM)
+
         # Set local project path
         local_project_path = django_settings.SITE_ROOT
 
@@ -111,10 +140,18 @@ class Command(ServerManagementBaseCommand):
             print('Staging domains to be enabled in nginx: ', staging_domain_names)
 
         # If the domain is pointing to the droplet already, we can setup SSL.
+        # The lookups run at the same time with the async backend.
+        backend = current_backend(env)
+        domain_names = staging_domain_names.split(' ')
+        lookups = backend.wait([
+            backend.local_async(f'dig +short {domain_name}')
+            for domain_name in domain_names
+        ])
+
         setup_ssl_for = [
             domain_name
-            for domain_name in staging_domain_names.split(' ')
-            if local(f'dig +short {domain_name}', capture=True) == remote['server']['ip']
+            for domain_name, lookup in zip(domain_names, lookups)
+            if lookup == remote['server']['ip']
         ]
 
         if not setup_ssl_for:
@@ -157,48 +194,61 @@ class Command(ServerManagementBaseCommand):
 
         print("")
 
-        # Create session_files
-        session_files = {
-            'supervisor_config': NamedTemporaryFile(mode='w+', delete=False),
-            'supervisor_init': NamedTemporaryFile(mode='w+', delete=False),
-            'nginx_production': NamedTemporaryFile(mode='w+', delete=False),
-            'nginx_staging': NamedTemporaryFile(mode='w+', delete=False),
-            'apt_periodic': NamedTemporaryFile(mode='w+', delete=False),
-            'certbot_cronjob': NamedTemporaryFile(mode='w+', delete=False),
+        # Find out what's on the server already, and size the services to it.
+        with report_step(env, 'Gather server facts'):
+            facts = gather_facts(project_folder)
+
+        tuning = service_tuning(facts, remote['server'].get('tuning'))
+        kernel = kernel_tuning(facts, remote['server'].get('kernel'))
+        nginx_config = nginx_options(remote['server'].get('nginx'))
+        pgbouncer = pgbouncer_options(facts, remote['database'].get('pgbouncer'))
+
+        if pgbouncer and pgbouncer['pool_mode'] not in ('session', 'transaction'):
+            abort('The PgBouncer pool_mode must be "session" or "transaction".')
+
+        # Render the configuration files. They're uploaded together (if they
+        # have changed) once the packages which own their folders are installed.
+        configs = {
+            'supervisor_config': ConfigFile('/etc/supervisor/supervisord.conf', render_to_string('supervisor_config', {
+                'project': project_folder,
+                'tuning': tuning,
+                'kernel': kernel,
+                'pgbouncer': pgbouncer,
+            })),
+            'supervisor_init': ConfigFile('/etc/init.d/supervisord', render_to_string('supervisor_init', {
+                'project': project_folder
+            }), mode=0o755),
+            'nginx_production': ConfigFile(f'/etc/nginx/sites-available/{project_folder}_production', render_to_string('nginx_production', {
+                'project': project_folder,
+                'domain_names': production_domain_names,
+                'fallback_domain_name': fallback_domain_name,
+                'nginx': nginx_config,
+            })),
+            'nginx_staging': ConfigFile(f'/etc/nginx/sites-available/{project_folder}_staging', render_to_string('nginx_staging', {
+                'project': project_folder,
+                'domain_names': staging_domain_names,
+                'fallback_domain_name': fallback_domain_name,
+                'nginx': nginx_config,
+            })),
+            'apt_periodic': ConfigFile('/etc/apt/apt.conf.d/10periodic', render_to_string('apt_periodic')),
+            'certbot_cronjob': ConfigFile('/etc/cron.d/certbot', render_to_string('certbot_cronjob')),
+            'sysctl_config': ConfigFile('/etc/sysctl.d/60-server-management.conf', render_to_string('sysctl_config', {
+                'kernel': kernel,
+            })),
+            'limits_config': ConfigFile('/etc/security/limits.d/60-server-management.conf', render_to_string('limits_config', {
+                'kernel': kernel,
+            })),
         }
 
-        # Parse files
-        session_files['supervisor_config'].write(render_to_string('supervisor_config', {
-            'project': project_folder
-        }))
-        session_files['supervisor_config'].close()
-
-        session_files['supervisor_init'].write(render_to_string('supervisor_init', {
-            'project': project_folder
-        }))
-        session_files['supervisor_init'].close()
-
-        # Production nginx config
-        session_files['nginx_production'].write(render_to_string('nginx_production', {
-            'project': project_folder,
-            'domain_names': production_domain_names,
-            'fallback_domain_name': fallback_domain_name
-        }))
-        session_files['nginx_production'].close()
-
-        # Staging nginx config
-        session_files['nginx_staging'].write(render_to_string('nginx_staging', {
-            'project': project_folder,
-            'domain_names': staging_domain_names,
-            'fallback_domain_name': fallback_domain_name
-        }))
-        session_files['nginx_staging'].close()
-
-        session_files['apt_periodic'].write(render_to_string('apt_periodic'))
-        session_files['apt_periodic'].close()
-
-        session_files['certbot_cronjob'].write(render_to_string('certbot_cronjob'))
-        session_files['certbot_cronjob'].close()
+        if pgbouncer:
+            configs['pgbouncer_config'] = ConfigFile('/etc/pgbouncer/pgbouncer.ini', render_to_string('pgbouncer_config', {
+                'database': remote['database']['name'],
+                'pgbouncer': pgbouncer,
+            }))
+            configs['pgbouncer_hba'] = ConfigFile('/etc/pgbouncer/pg_hba.conf', render_to_string('pgbouncer_hba', {
+                'database': remote['database']['name'],
+                'user': remote['database']['user'],
+            }))
 
         # Define the locales first.
         locale_tasks = [
@@ -232,78 +282,60 @@ class Command(ServerManagementBaseCommand):
 
         python_version_full = remote['server'].get('python_version', '3')
         pip_command = 'pip3'
+        pip_cache_dir = env.get('pip_cache_dir', '~/.cache/pip')  # Shared with fabvenv.
         python_command = f'python{python_version_full}'
 
-        # Define base tasks
-        base_tasks = [
-            # Add nginx and Let's Encrypt PPAs.  We add them up here because an
-            # `apt-get update` is require for them to be truly added and that
-            # comes next.
-            {
-                'title': 'Add nginx PPA',
-                'command': 'add-apt-repository -y ppa:nginx/stable',
-            },
-            {
-                'title': "Add Let's Encrypt PPA",
-                'command': 'add-apt-repository -y ppa:certbot/certbot',
-            },
-            {
-                'title': 'Update apt cache',
-                'command': 'apt-get update',
-            },
-            {
-                'title': 'Upgrade everything',
-                'command': 'apt-get upgrade -yq',
-            },
-            {
-                'title': 'Install unattended-upgrades',
-                'command': 'apt-get install -y unattended-upgrades',
-            },
-            {
-                'title': "Install the base packages",
-                'command': 'apt-get install -y {}'.format(
-                    ' '.join([
-                        # Base requirements
-                        'build-essential',
-                        'git',
-                        'ufw',  # Installed by default on Ubuntu, not elsewhere
-
-                        # Project requirements
-                        f'{python_command}-dev',
-                        'python-pip',  # For supervisor
-                        'python3-pip',
-                        'apache2-utils',  # Required for htpasswd
-                        'python3-passlib',  # Required for generating the htpasswd file
-                        'libjpeg-dev',
-                        'libffi-dev',
-                        'libssl-dev',  # Required for nvm.
-                        'nodejs',
-                        'memcached',
-                        'fail2ban',
-
-                        # Nginx things
-                        'nginx',
-                        'certbot',
-                        'python-certbot-nginx',
+        # Everything we need from apt. The packages which are already
+        # installed are skipped, so re-deploys don't hit the network for them.
+        base_packages = [
+            # Base requirements
+            'build-essential',
+            'git',
+            'ufw',  # Installed by default on Ubuntu, not elsewhere
+            'unattended-upgrades',
+
+            # Project requirements
+            f'{python_command}-dev',
+            f'{python_command}-venv',
+            'python-pip',  # For supervisor
+            'python3-pip',
+            'apache2-utils',  # Required for htpasswd
+            'python3-passlib',  # Required for generating the htpasswd file
+            'libjpeg-dev',
+            'libffi-dev',
+            'libssl-dev',  # Required for nvm.
+            'nodejs',
+            'memcached',
+            'fail2ban',
+
+            # Nginx things
+            'nginx',
+            'certbot',
+            'python-certbot-nginx',
+
+            # Postgres requirements
+            'postgresql',
+            'libpq-dev',
+            'python3-psycopg2',  # TODO: Is this required?
+            'pgbouncer' if pgbouncer else '',
+
+            # Other
+            'libgeoip-dev' if optional_packages.get('geoip', True) else '',
+            'libmysqlclient-dev' if optional_packages.get('mysql', True) else '',
+            'python3.6',
+            'python3.6-dev',
+        ]
 
-                        # Postgres requirements
-                        'postgresql',
-                        'libpq-dev',
-                        'python3-psycopg2',  # TODO: Is this required?
+        # Add nginx and Let's Encrypt PPAs before the (single) `apt-get update`.
+        run_tasks(env, apt_tasks(
+            base_packages,
+            repositories=['ppa:nginx/stable', 'ppa:certbot/certbot'],
+            proxy=remote['server'].get('apt_proxy', config.get('apt_proxy')),
+            installed=facts['package'],
+        ), policy='retry-3')
 
-                        # Other
-                        'libgeoip-dev' if optional_packages.get('geoip', True) else '',
-                        'libmysqlclient-dev' if optional_packages.get('mysql', True) else '',
-                        'python3.6',
-                        'python3.6-dev',
-                    ])
-                )
-            },
-            {
-                'title': 'Adjust APT update intervals',
-                'fabric_command': 'put',
-                'fabric_args': [session_files['apt_periodic'].name, '/etc/apt/apt.conf.d/10periodic'],
-            },
+        # Define base tasks
+        base_tasks = [
             {
                 'title': 'Update pip',
                 'command': f'{pip_command} install -U pip'
@@ -324,70 +356,85 @@ class Command(ServerManagementBaseCommand):
 
         run_tasks(env, base_tasks)
 
-        # Configure swap
+        # Everything rendered above which differs from the server, in one go.
+        with report_step(env, 'Upload the configuration files'):
+            changed_configs = {config.remote_path for config in upload_configs(list(configs.values()))}
+
+        # A config stays in changed_configs (on later runs too) until the
+        # reload which applies it succeeds. These are read as they're used.
+        configs_applied([configs[name] for name in ('supervisor_init', 'apt_periodic', 'certbot_cronjob', 'limits_config')])
+
+        # Configure swap, sized by kernel_tuning. An existing swap file is left
+        # alone (it may be in use).
         swap_tasks = [
             {
                 'title': 'Create a swap file',
-                'command': 'fallocate -l 4G /swapfile',
+                'command': f'fallocate -l {kernel["swap_mb"]}M /swapfile',
+                'check': 'test -f /swapfile',
             },
             {
                 'title': 'Set permissions on swapfile to 600',
-                'command': 'chmod 0600 /swapfile'
+                'command': 'chmod 0600 /swapfile',
+                'check': 'test "$(stat -c %a /swapfile)" = 600',
             },
             {
                 'title': 'Format swapfile for swap',
                 'command': 'mkswap /swapfile',
+                'check': 'swapon --show=NAME --noheadings | grep -qx /swapfile',
             },
             {
                 'title': 'Add the file to the system as a swap file',
                 'command': 'swapon /swapfile',
+                'check': 'swapon --show=NAME --noheadings | grep -qx /swapfile',
             },
             {
                 'title': 'Write fstab line for swapfile',
                 'command': "echo '/swapfile none swap sw 0 0' >> /etc/fstab",
+                'check': "grep -q '^/swapfile ' /etc/fstab",
             },
+        ] if kernel['swap_mb'] else []
+
+        # The sysctls live in their own file now (see the configs above),
+        # earlier deploys appended them to /etc/sysctl.conf.
+        kernel_tasks = swap_tasks + [
             {
-                'title': 'Change swappiness',
-                'command': 'sysctl vm.swappiness=10'
-            },
-            {
-                'title': 'Write swappiness to file',
-                'command': "echo 'vm.swappiness=10' >> /etc/sysctl.conf",
-            },
-            {
-                'title': 'Reduce cache pressure',
-                'command': 'sysctl vm.vfs_cache_pressure=50',
+                'title': 'Remove the old sysctl.conf settings',
+                'command': "sed -i '/^vm.swappiness=10$/d; /^vm.vfs_cache_pressure=50$/d' /etc/sysctl.conf",
+                'check': "! grep -qE '^vm.(swappiness=10|vfs_cache_pressure=50)$' /etc/sysctl.conf",
             },
-            {
-                'title': 'Write cache pressure to file',
-                'command': "echo 'vm.vfs_cache_pressure=50' >> /etc/sysctl.conf",
-            }
         ]
 
-        # Check to see if we've already configured a swap file. This handles
-        # the case where the deploy command is being re-run.
-        cache_pressure = run('cat /proc/sys/vm/vfs_cache_pressure')
+        if configs['sysctl_config'].remote_path in changed_configs:
+            kernel_tasks.append({
+                'title': 'Apply the kernel settings',
+                'command': f'sysctl -p {configs["sysctl_config"].remote_path}',
+            })
 
-        if cache_pressure != '50':
-            run_tasks(env, swap_tasks)
+        run_tasks(env, kernel_tasks, batch=True)
+        configs_applied([configs['sysctl_config']])
 
         # Define SSH tasks
         ssh_tasks = [
             {
                 'title': 'Create the application group',
                 'command': 'addgroup --system webapps',
+                'check': lambda: 'webapps' in facts['group'],
             },
             {
                 'title': 'Add the application user',
                 'command': f'adduser --shell /bin/bash --system --disabled-password --ingroup webapps {project_folder}',
+                'check': lambda: project_folder in facts['user'],
             },
             {
                 'title': "Add .ssh folder to application user's home directory",
                 'command': f'mkdir ~{project_folder}/.ssh',
+                'check': f'test -d ~{project_folder}/.ssh',
             },
             {
                 'title': 'Generate SSH keys for application user',
                 'command': f"ssh-keygen -C application-server -f ~{project_folder}/.ssh/id_rsa -N ''",
+                # Reuse the existing key, it's already registered with the Git host.
+                'check': lambda: bool(facts.get('ssh_key')),
             },
             {
                 'title': 'Make the application directory',
@@ -413,14 +460,17 @@ class Command(ServerManagementBaseCommand):
             {
                 'title': 'Add deploy user',
                 'command': 'adduser --shell /bin/bash --disabled-password --system --ingroup webapps deploy',
+                'check': lambda: 'deploy' in facts['user'],
             },
             {
                 'title': "Add .ssh folder to deploy user's home directory",
                 'command': 'mkdir ~deploy/.ssh',
+                'check': 'test -d ~deploy/.ssh',
             },
             {
                 'title': 'Add authorized keys to deploy user',
                 'command': f'mv ~{env.user}/.ssh/authorized_keys /home/deploy/.ssh/authorized_keys',
+                'check': 'test -s /home/deploy/.ssh/authorized_keys',
             },
             {
                 'title': 'Check deploy user file permissions',
@@ -456,99 +506,79 @@ class Command(ServerManagementBaseCommand):
                 'command': 'service ssh restart',
             }
         ]
-        run_tasks(env, ssh_tasks)
-
-        # Define db tasks
-        db_name = remote['database']['name']
-        db_user = remote['database']['user']
-
-        db_tasks = [
-            {
-                'title': 'Create the application postgres role',
-                'command': f'su - postgres -c "createuser {db_user}"',
-            },
-            {
-                'title': 'Ensure database is created',
-                'command': f'su - postgres -c "createdb {db_name} --encoding=UTF-8 --locale=en_GB.UTF-8 --template=template0 --owner={db_user} --no-password"',
-            },
-            {
-                'title': 'Ensure user has access to the database',
-                'command': f'su - postgres -c "psql {db_name} -c \'GRANT ALL ON DATABASE {db_name} TO {db_user}\'"',
-            },
-            {
-                'title': 'Ensure user does not have unnecessary privileges',
-                'command': f'su - postgres -c "psql {db_name} -c \'ALTER USER {db_user} WITH NOSUPERUSER NOCREATEDB\'"',
-            },
-        ]
-        run_tasks(env, db_tasks)
+        run_tasks(env, ssh_tasks, batch=True)
 
         # Get SSH Key from server
-        ssh_key = run(f'cat ~{project_folder}/.ssh/id_rsa.pub')
+        ssh_key = facts.get('ssh_key') or run(f'cat ~{project_folder}/.ssh/id_rsa.pub')
 
-        # Get the current SSH keys in the repo
+        # The Bitbucket / Github and CircleCI calls run alongside the server
+        # tasks with the async backend, so they don't print anything until
+        # we wait for them.
         if is_bitbucket_repo:
-            task_title = 'Checking bitbucket repository for an existing SSH key'
+            vcs, vcs_account, vcs_repo = Bitbucket(bitbucket_username, bitbucket_password), bitbucket_account, bitbucket_repo
+        else:
+            vcs, vcs_account, vcs_repo = GitHub(github_token), github_account, github_repo
 
-            title_print(task_title, state='task')
+        deploy_key_title = 'Adding the SSH key to {}'.format('bitbucket' if is_bitbucket_repo else 'Github')
 
-            try:
-                repo_ssh_keys = requests.get('https://bitbucket.org/api/1.0/repositories/{}/{}/deploy-keys/'.format(
-                    bitbucket_account,
-                    bitbucket_repo,
-                ), auth=(bitbucket_username, bitbucket_password))
-            except requests.RequestException:
-                title_print(task_title, state='failed')
-                exit()
-
-            title_print(task_title, state='succeeded')
-
-            task_title = 'Adding the SSH key to bitbucket'
-
-            if repo_ssh_keys.text.find(ssh_key) == -1:
-                title_print(task_title, state='task')
-
-                try:
-                    requests.post(
-                        'https://bitbucket.org/api/1.0/repositories/{}/{}/deploy-keys/'.format(
-                            bitbucket_account,
-                            bitbucket_repo,
-                        ),
-                        data=urlencode({
-                            'label': f'Application Server ({env.host_string})',
-                            'key': ssh_key,
-                        }),
-                        auth=(bitbucket_username, bitbucket_password)
-                    )
-                except Exception as e:
-                    title_print(task_title, state='failed')
-                    raise e
-
-                title_print(task_title, state='succeeded')
+        def add_deploy_key():
+            with report_step(env, deploy_key_title):
+                return vcs.add_deploy_key(vcs_account, vcs_repo, f'Application Server ({env.host_string})', ssh_key)
 
-        elif is_github_repo:
-            task_title = 'Adding the SSH key to Github'
+        def add_to_circleci():
+            with report_step(env, 'Add the project to CircleCI'):
+                if not os.path.exists('dist/id_rsa'):
+                    local("mkdir -p dist; ssh-keygen -C circleci -f dist/id_rsa -N ''", capture=True)
+
+                circleci = CircleCI(circle_token)
+                circleci.follow(github_account, github_repo)
 
-            title_print(task_title, state='task')
+                with open('dist/id_rsa', 'r') as private_key:
+                    return circleci.add_ssh_key(github_account, github_repo, fallback_domain_name, private_key.read())
+
+        def wait_for(title, future):
+            title_print(title, state='task')
 
             try:
-                response = requests.post(
-                    f'https://api.github.com/repos/{github_account}/{github_repo}/keys',
-                    json={
-                        'title': f'Application Server ({env.host_string})',
-                        'key': ssh_key,
-                        'read_only': True,
-                    },
-                    headers={
-                        'Authorization': f'token {github_token}',
-                    })
-
-                if options.get('debug', False):
-                    print(response.text)
+                added = future.result()
             except Exception as e:
-                title_print(task_title, state='failed')
+                title_print(title, state='failed')
                 raise e
 
-            title_print(task_title, state='succeeded')
+            title_print(title, state='succeeded' if added else 'skipped')
+
+        deploy_key = backend.call_async(add_deploy_key)
+        circle_project = backend.call_async(add_to_circleci) if circle_token and is_github_repo else None
+
+        # Size PostgreSQL to the server.
+        postgres_version = facts.get('postgres_version') or str(
+            backend.run('ls /etc/postgresql | sort -V | tail -n 1', quiet=True)
+        ).strip()
+        postgres_config = ConfigFile(f'/etc/postgresql/{postgres_version}/main/conf.d/60-server-management.conf', render_to_string('postgresql_config', {
+            'settings': postgres_tuning(facts, postgres_version, remote['database'].get('tuning')),
+        }))
+
+        with report_step(env, 'Upload the PostgreSQL config'):
+            changed_postgres = upload_configs([postgres_config], title='Upload the PostgreSQL config')
+
+        if changed_postgres:
+            run_tasks(env, postgres_reload_tasks())
+            configs_applied(changed_postgres)
+
+        db_name = remote['database']['name']
+        db_user = remote['database']['user']
+        run_tasks(env, database_tasks(db_name, db_user))
+
+        if pgbouncer:
+            run_tasks(env, pgbouncer_tasks(
+                f'/etc/postgresql/{postgres_version}/main',
+                db_name,
+                db_user,
+                restart=bool({configs['pgbouncer_config'].remote_path, configs['pgbouncer_hba'].remote_path} & changed_configs),
+            ))
+            configs_applied([configs['pgbouncer_config'], configs['pgbouncer_hba']])
+
+        wait_for(deploy_key_title, deploy_key)
 
         # Define git tasks
         if is_bitbucket_repo:
@@ -557,19 +587,30 @@ class Command(ServerManagementBaseCommand):
             git_url = f'git@github.com:{github_account}/{github_repo}.git'
 
         git_branch = local('git symbolic-ref --short HEAD', capture=True)
+        git = git_options(remote['server'], git_url)
+
+        if git['mirror']:
+            run_tasks(env, [
+                {
+                    'title': 'Make the shared Git mirror directory',
+                    'command': 'install -d -m 2775 -g webapps {}'.format(os.path.dirname(git['mirror'])),
+                },
+            ])
 
         git_tasks = [
             {
                 'title': 'Add Github key to known hosts',
                 'command': f'ssh-keyscan -H github.com >> ~{project_folder}/.ssh/known_hosts',
             },
+            {
+                'title': 'Update the shared Git mirror',
+                'command': mirror_command(git_url, git['mirror']),
+                'check': lambda: not git['mirror'],
+            },
             {
                 'title': 'Setup the Git repo',
-                'command': 'cd /tmp; git clone -b {branch} {url} {project}'.format(
-                    branch=git_branch,
-                    url=git_url,
-                    project=f'/var/www/{project_folder}',
-                ),
+                'command': 'cd /tmp; ' + clone_command(git_url, git_branch, f'/var/www/{project_folder}', git),
+                'check': lambda: bool(facts.get('git_hash')),
             },
         ]
         run_tasks(env, git_tasks, user=project_folder)
@@ -582,6 +623,7 @@ class Command(ServerManagementBaseCommand):
                     f'mkdir -m 0775 -p {django_settings.STATIC_ROOT}',
                     f'chown {project_folder}:webapps {django_settings.STATIC_ROOT}',
                 ]),
+                'concurrent': True,
             },
             {
                 'title': 'Make the media directory',
@@ -589,29 +631,32 @@ class Command(ServerManagementBaseCommand):
                     f'mkdir -m 0775 -p {django_settings.MEDIA_ROOT}',
                     f'chown {project_folder}:webapps {django_settings.MEDIA_ROOT}'
                 ]),
+                'concurrent': True,
             },
         ]
         run_tasks(env, static_tasks)
 
         # Define venv tasks
-        git_hash = run(f'cd /var/www/{project_folder}; git rev-parse --short HEAD')
+        git_hash = facts.get('git_hash') or run(f'cd /var/www/{project_folder}; git rev-parse --short HEAD')
         venv_path = f'/var/www/{project_folder}/.venv-{git_hash}'
 
         venv_tasks = [
             {
                 'title': 'Create the virtualenv for this commit',
-                'command': f'virtualenv -p python{python_version_full} {venv_path}',
+                'command': f'{python_command} -m venv {venv_path}',
+                'check': f'test -x {venv_path}/bin/python',
             },
             {
                 'title': 'Symlink the .venv folder to the commit venv',
                 'command': f'ln -s {venv_path} /var/www/{project_folder}/.venv',
+                'check': f'test -L /var/www/{project_folder}/.venv',
             },
             # This shouldn't be necessary (we think we upgraded pip earlier)
             # but it is - you'll get complaints about bdist_wheel without
             # this.
             {
                 'title': 'Upgrade pip inside the virtualenv',
-                'command': f'/var/www/{project_folder}/.venv/bin/pip install --upgrade pip',
+                'command': f'/var/www/{project_folder}/.venv/bin/pip install --cache-dir {pip_cache_dir} --upgrade pip',
             },
         ]
         run_tasks(env, venv_tasks, user=project_folder)
@@ -628,7 +673,7 @@ class Command(ServerManagementBaseCommand):
                 )
             },
         ]
-        run_tasks(env, gunicorn_tasks)
+        run_tasks(env, gunicorn_tasks, batch=True)
 
         log_tasks = [
             {
@@ -640,71 +685,88 @@ class Command(ServerManagementBaseCommand):
                 ]),
             },
         ]
-        run_tasks(env, log_tasks)
+        run_tasks(env, log_tasks, batch=True)
 
         requirement_tasks = [
             {
-                # Check to see if we have a requirements file. Even though we check for
-                # it at the start of the deployment process, it hasn't necessarily been
-                # committed. So this check covers that.
+                # The requirements file is optional: even though we check for
+                # it at the start of the deployment process, it hasn't
+                # necessarily been committed. Gunicorn is resolved in the same
+                # pass, with the cache shared by every venv for the project.
 
                 # We cd to /tmp/ because git lines in the requirements files breaks things.
 
                 'title': "Install packages required by the Django app inside virtualenv",
-                'command': 'if [ -f /var/www/{project}/requirements.txt ]; then cd /tmp; /var/www/{project}/.venv/bin/pip '
-                           'install -r /var/www/{project}/requirements.txt; fi'.format(
+                'command': 'cd /tmp; /var/www/{project}/.venv/bin/pip install --cache-dir {cache} '
+                           '$(test -f /var/www/{project}/requirements.txt && echo "-r /var/www/{project}/requirements.txt") '
+                           'gunicorn'.format(
                                project=project_folder,
+                               cache=pip_cache_dir,
                            ),
             },
-            {
-                'title': 'Make sure Gunicorn is installed',
-                'command': f'/var/www/{project_folder}/.venv/bin/pip install gunicorn',
-            },
         ]
 
-        run_tasks(env, requirement_tasks, user=project_folder)
+        run_tasks(env, requirement_tasks, user=project_folder, policy='retry-2')
+
+        # The certificate only needs (re)issuing when it doesn't cover all of
+        # the domains, and Nginx only needs stopping for that.
+        certificate = f'/etc/letsencrypt/live/{fallback_domain_name}/fullchain.pem'
+        certificate_check = ' && '.join(
+            [f'test -e {certificate}'] + [
+                f'openssl x509 -in {certificate} -noout -text | grep -qE "DNS:{domain_name}(,|$)"'
+                for domain_name in setup_ssl_for
+            ]
+        )
 
         # Define nginx tasks
         nginx_tasks = [
             {
                 'title': 'Ensure Nginx service is stopped',  # This allows Certbot to run.
                 'command': 'service nginx stop',
+                'check': certificate_check,
             },
             {
-                'title': 'Create the production Nginx configuration file',
-                'fabric_command': 'put',
-                'fabric_args': [
-                    session_files['nginx_production'].name,
-                    f'/etc/nginx/sites-available/{project_folder}_production',
-                ],
+                'title': 'Create the Nginx cache directory',
+                'command': 'mkdir -p /var/cache/nginx',
+                'check': 'test -d /var/cache/nginx',
             },
             {
-                'title': 'Create the staging Nginx configuration file',
-                'fabric_command': 'put',
-                'fabric_args': [
-                    session_files['nginx_staging'].name,
-                    f'/etc/nginx/sites-available/{project_folder}_staging',
-                ],
+                'title': 'Size the Nginx worker processes',
+                'command': '; '.join([
+                    "sed -i 's/^\\s*worker_processes .*/worker_processes {};/' /etc/nginx/nginx.conf",
+                    "sed -i 's/^\\s*worker_connections .*/\\tworker_connections {};/' /etc/nginx/nginx.conf",
+                ]).format(
+                    tuning['nginx_worker_processes'],
+                    tuning['nginx_worker_connections'],
+                ),
+                'check': 'grep -q "^worker_processes {};" /etc/nginx/nginx.conf && grep -q "^\\s*worker_connections {};" /etc/nginx/nginx.conf'.format(
+                    tuning['nginx_worker_processes'],
+                    tuning['nginx_worker_connections'],
+                ),
             },
             {
                 'title': 'Create the .htpasswd file',
                 'command': 'htpasswd -c -b /etc/nginx/htpasswd onespace media',
+                'check': 'htpasswd -v -b /etc/nginx/htpasswd onespace media',
             },
             {
                 'title': 'Ensure that the default site is disabled',
                 'command': 'rm /etc/nginx/sites-enabled/default',
+                'check': 'test ! -e /etc/nginx/sites-enabled/default',
             },
             {
                 'title': 'Ensure that the production Nginx config is enabled',
                 'command': 'ln -s /etc/nginx/sites-available/{project}_production /etc/nginx/sites-enabled/{project}_production'.format(
                     project=project_folder,
                 ),
+                'check': f'test -L /etc/nginx/sites-enabled/{project_folder}_production',
             },
             {
                 'title': 'Ensure that the staging Nginx config is enabled',
                 'command': 'ln -s /etc/nginx/sites-available/{project}_staging /etc/nginx/sites-enabled/{project}_staging'.format(
                     project=project_folder,
                 ),
+                'check': f'test -L /etc/nginx/sites-enabled/{project_folder}_staging',
             },
             {
                 'title': 'Run certbot',
@@ -713,26 +775,35 @@ class Command(ServerManagementBaseCommand):
                                fallback_domain_name,
                                ','.join(setup_ssl_for)
                            ),
+                'check': certificate_check,
             },
-            {
-                'title': 'Generate DH parameters (this may take a little while)',
-                'command': 'openssl dhparam -out /etc/ssl/dhparam.pem 2048',
-            },
+        ]
+        nginx_results = run_tasks(env, nginx_tasks)
+
+        # Reload (rather than restart) Nginx if any of its config changed.
+        reload_nginx = any(result.state == 'succeeded' for result in nginx_results) or any(
+            configs[name].remote_path in changed_configs
+            for name in ('nginx_production', 'nginx_staging')
+        )
+
+        with report_step(env, 'Upload DH parameters'):
+            artifacts.install(DHPARAM, 'Upload DH parameters')
+
+        nginx_tasks = [
             {
                 'title': 'Ensure Nginx service is started',
                 'command': 'service nginx start',
             },
-            {
-                'title': 'Configure certbot cronjob',
-                'fabric_command': 'put',
-                'fabric_args': [session_files['certbot_cronjob'].name, '/etc/cron.d/certbot'],
-            },
-            {
-                'title': 'Ensure the certbot cronjob has the correct file permissions',
-                'command': 'chmod 0644 /etc/cron.d/certbot',
-            },
         ]
+
+        if reload_nginx:
+            nginx_tasks.append({
+                'title': 'Reload the Nginx configuration',
+                'command': 'nginx -t && nginx -s reload',
+            })
+
         run_tasks(env, nginx_tasks)
+        configs_applied([configs['nginx_production'], configs['nginx_staging']])
 
         # Configure the firewall.
         firewall_tasks = [
@@ -757,26 +828,7 @@ class Command(ServerManagementBaseCommand):
             {
                 'title': 'Create the Supervisor config folder',
                 'command': 'sudo mkdir /etc/supervisor',
-            },
-            {
-                'title': 'Create the Supervisor config file',
-                'fabric_command': 'put',
-                'fabric_args': [
-                    session_files['supervisor_config'].name,
-                    '/etc/supervisor/supervisord.conf',
-                ],
-            },
-            {
-                'title': 'Create the Supervisor init script',
-                'fabric_command': 'put',
-                'fabric_args': [
-                    session_files['supervisor_init'].name,
-                    '/etc/init.d/supervisord',
-                ],
-            },
-            {
-                'title': 'Make the Supervisor init script executable',
-                'command': 'chmod +x /etc/init.d/supervisord',
+                'check': 'test -d /etc/supervisor',
             },
             {
                 'title': 'Add Supervisor to the list of services',
@@ -797,8 +849,23 @@ class Command(ServerManagementBaseCommand):
                 'title': 'Start Supervisor',
                 'command': 'service supervisord start',
             },
+            {
+                # minfds is only read when supervisord starts.
+                'title': 'Restart Supervisor to raise its open file limit',
+                'command': 'service supervisord restart',
+                'check': SUPERVISOR_NOFILE_CHECK.format(nofile=kernel['nofile']),
+            },
         ]
+
+        # A running Supervisor picks up a changed config without a restart.
+        if configs['supervisor_config'].remote_path in changed_configs:
+            supervisor_tasks.append({
+                'title': 'Reload the Supervisor config',
+                'command': 'supervisorctl reread && supervisorctl update',
+            })
+
         run_tasks(env, supervisor_tasks)
+        configs_applied([configs['supervisor_config']])
 
         # Define build system tasks
         build_systems = {
@@ -844,49 +911,21 @@ class Command(ServerManagementBaseCommand):
         }
 
         run_tasks(env, build_systems[remote['server'].get('build_system', 'none')], user=project_folder)
-
-        # Delete files
-        for session_file in session_files:
-            os.unlink(session_files[session_file].name)
+        run_tasks(env, precompress_tasks(f'/var/www/{project_folder}_static'), user=project_folder)
 
         # Add the project to CircleCI
-        circle_tasks = [
-            {
-                'title': 'Create the CircleCI SSH key',
-                'fabric_command': 'local',
-                'fabric_args': ["mkdir -p dist; ssh-keygen -C circleci -f dist/id_rsa -N ''"],
-            },
-            {
-                'title': 'Follow the project on CircleCI',
-                'fabric_command': 'local',
-                'fabric_args': [
-                    f'curl -X POST https://circleci.com/api/v1.1/project/github/{github_account}/{github_repo}/follow?circle-token={circle_token}',
-                ]
-            },
-            {
-                'title': 'Add private SSH key to CircleCI',
-                'fabric_command': 'local',
-                'fabric_args': [
-                    'curl -X POST --header "Content-Type: application/json" -d \'{{"hostname":"{'
-                    'fallback_domain_name}","private_key":"{private_key}"}}\' '
-                    'https://circleci.com/api/v1.1/project/github/{github_account}/{'
-                    'github_repo}/ssh-key?circle-token={circle_token}'.format(
-                        fallback_domain_name=fallback_domain_name,
-                        private_key=open('dist/id_rsa', 'r').read(),
-                        github_account=github_account,
-                        github_repo=github_repo,
-                        circle_token=circle_token,
-                    )]
-            },
-            {
-                'title': 'Add public key to server',
-                'command': 'echo "{}" >> ~deploy/.ssh/authorized_keys'.format(
-                    open('dist/id_rsa.pub', 'r').read()
-                )
-            },
-        ]
+        if circle_project:
+            wait_for('Add the project to CircleCI', circle_project)
 
-        if circle_token and is_github_repo:
-            run_tasks(env, circle_tasks)
+            with open('dist/id_rsa.pub', 'r') as public_key_file:
+                public_key = public_key_file.read().strip()
+
+            run_tasks(env, [
+                {
+                    'title': 'Add public key to server',
+                    'command': f'echo "{public_key}" >> ~deploy/.ssh/authorized_keys',
+                    'check': f'grep -qF "{public_key}" ~deploy/.ssh/authorized_keys',
+                },
+            ])
 
         print('Initial application deployment has completed. You should now pushdb and pushmedia.')
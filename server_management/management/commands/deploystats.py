@@ -0,0 +1,123 @@
+import glob
+import json
+import os
+import time
+
+from fabric.colors import green, red
+
+from ._core import ServerManagementBaseCommand, get_cache_dir, get_remote
+
+
+def load_reports(host, command):
+    paths = sorted(glob.glob(os.path.join(get_cache_dir('reports', host), f'{command}-*.json')))
+    reports = []
+
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as report_file:
+            reports.append(json.load(report_file))
+
+    return reports
+
+
+def step_durations(report):
+    # Steps can share a title (e.g. gathering facts twice), so total them.
+    durations = {}
+
+    for step in report['steps']:
+        durations[step['title']] = durations.get(step['title'], 0) + step['duration']
+
+    return durations
+
+
+def find_regressions(latest, previous, threshold=0.2, minimum=1.0):
+    # Steps which took `threshold` (as a fraction) and `minimum` seconds longer
+    # than in the previous run.
+    latest_durations = step_durations(latest)
+    previous_durations = step_durations(previous)
+    regressions = []
+
+    for title, duration in latest_durations.items():
+        before = previous_durations.get(title)
+
+        if before is None:
+            continue
+
+        if duration - before >= minimum and duration > before * (1 + threshold):
+            regressions.append((title, before, duration))
+
+    return sorted(regressions, key=lambda regression: regression[2] - regression[1], reverse=True)
+
+
+def print_runs(reports):
+    print('Recent runs:')
+    for report in reports:
+        failed = [step for step in report['steps'] if step['state'] == 'failed']
+
+        print('  {}  {:>8.1f}s  {} steps{}'.format(
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(report['started'])),
+            report['duration'],
+            len(report['steps']),
+            red(' (failed)') if failed else '',
+        ))
+
+
+def print_slowest_steps(report, limit):
+    print('Slowest steps in the latest run:')
+    slowest = sorted(report['steps'], key=lambda step: step['duration'], reverse=True)
+
+    for step in slowest[:limit]:
+        remote = '' if step['remote_duration'] is None else ' (remote {:.1f}s)'.format(step['remote_duration'])
+        transferred = '' if not step['transferred'] else ' ({:,} bytes)'.format(step['transferred'])
+
+        print('  {:>8.1f}s  {}{}{}'.format(step['duration'], step['title'], remote, transferred))
+
+
+def print_regressions(latest, previous):
+    regressions = find_regressions(latest, previous)
+
+    if not regressions:
+        print(green('No regressions since the previous run.'))
+        return
+
+    print(red('Regressions since the previous run:'))
+    for title, before, after in regressions:
+        print('  {:>8.1f}s -> {:>8.1f}s  {}'.format(before, after, title))
+
+
+class Command(ServerManagementBaseCommand):
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+
+        parser.add_argument(
+            '--command',
+            dest='command',
+            default='deploy',
+            help='The command to show reports for (deploy or update).',
+        )
+
+        parser.add_argument(
+            '--limit',
+            dest='limit',
+            type=int,
+            default=10,
+            help='The number of slowest steps to show.',
+        )
+
+    def handle(self, *args, **options):
+        remote_prompt, config = get_remote(options.get('remote', ''))
+        host = config['remotes'][remote_prompt]['server']['ip']
+
+        reports = load_reports(host, options['command'])
+
+        if not reports:
+            print('No {} reports for {}.'.format(options['command'], remote_prompt))
+            return
+
+        print_runs(reports[-5:])
+        print('')
+        print_slowest_steps(reports[-1], options['limit'])
+
+        if len(reports) >= 2:
+            print('')
+            print_regressions(reports[-1], reports[-2])
@@ -1,10 +1,44 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings as django_settings
 from django.core.management import call_command
+from django.db import connections
+from fabric.api import env
 
 from server_management.management.commands._core import ServerManagementBaseCommand, title_print, get_remote
 
+try:
+    from sorl.thumbnail import delete as delete_thumbnails, get_thumbnail
+except ImportError:
+    delete_thumbnails = get_thumbnail = None
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+
+
+def setup_worker():
+    # Workers are spawned rather than forked on macOS (and Windows), so they
+    # start without Django set up. Under fork this does nothing.
+    django.setup()
+
+
+def pregenerate(name, geometries):
+    for geometry in geometries:
+        get_thumbnail(name, geometry)
+
 
 class Command(ServerManagementBaseCommand):
 
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+
+        parser.add_argument(
+            '--thumbnails',
+            dest='thumbnails',
+            default=','.join(getattr(django_settings, 'SERVER_MANAGEMENT_THUMBNAIL_SIZES', [])),
+            help='Comma separated thumbnail geometries (e.g. 300x300,800) to generate for the images which changed.',
+        )
+
     def handle(self, *args, **options):
         remote_prompt, _ = get_remote(options.get('remote', ''))
 
@@ -16,4 +50,37 @@ class Command(ServerManagementBaseCommand):
         call_command('pullmedia', remote=remote_prompt)
         title_print('Pulling media', 'succeeded')
 
-        call_command('thumbnail', 'clear')
+        if delete_thumbnails:
+            self.refresh_thumbnails(
+                env.get('media_changes', []),
+                [geometry for geometry in options['thumbnails'].split(',') if geometry],
+            )
+
+    @staticmethod
+    def refresh_thumbnails(changed, geometries):
+        # The thumbnails of images which changed are stale. The key value store
+        # came down with the database, so it also refers to thumbnails which
+        # were only generated on the server; `cleanup` forgets those, and
+        # they're regenerated when they are next used.
+        title_print('Refreshing thumbnails', 'task')
+
+        for name in changed:
+            delete_thumbnails(name, delete_file=False)
+
+        call_command('thumbnail', 'cleanup')
+        title_print('Refreshing thumbnails', 'succeeded')
+
+        images = [name for name in changed if name.lower().endswith(IMAGE_EXTENSIONS)]
+
+        if not geometries or not images:
+            return
+
+        title_print('Generating thumbnails', 'task')
+
+        # Forked workers must not share our database connection.
+        connections.close_all()
+
+        with ProcessPoolExecutor(initializer=setup_worker) as pool:
+            list(pool.map(pregenerate, images, [geometries] * len(images), chunksize=8))
+
+        title_print('Generating thumbnails', 'succeeded')
@@ -1,37 +1,35 @@
-from fabric.api import env, local, settings, sudo
+from django.core.management.base import CommandError
+from fabric.api import env, local, settings
 
 from ._core import ServerManagementBaseCommand, load_config
+from ._dumps import cached_dump
+from ._snapshots import SnapshotStore
 
 
 class Command(ServerManagementBaseCommand):
 
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+
+        parser.add_argument(
+            '--no-snapshot',
+            dest='snapshot',
+            action='store_false',
+            default=True,
+            help="Don't keep a snapshot of the pulled database for resetdb.",
+        )
+
     def handle(self, *args, **options):
         # Load server config from project
         config, remote = load_config(env, options.get('remote', ''), debug=options.get('debug', False))
 
-        with settings(warn_only=True):
-            # Dump the database on the server.
-            sudo("su - {user} -c 'pg_dump {name} -cOx -U {user} -f /home/{user}/{name}.sql --clean'".format(
-                name=remote['database']['name'],
-                user=remote['database']['user'],
-            ))
-
-            # Pull the SQL file down.
-            local('scp {} {}@{}:/home/{}/{}.sql ~/{}.sql'.format(
-                '' if not getattr(env, 'key_filename') else ' -i {} '.format(env.key_filename),
-                env.user,
-                env.host_string,
-                remote['database']['user'],
-                remote['database']['name'],
-                config['local']['database']['name'],
-            ))
+        # Reuses the last dump if nothing has been written since.
+        dump_path = cached_dump(env, remote)
 
-            # Delete the file on the server.
-            sudo('rm -f /home/{}/{}.sql'.format(
-                remote['database']['user'],
-                remote['database']['name'],
-            ))
+        if not dump_path:
+            raise CommandError('Unable to dump the remote database.')
 
+        with settings(warn_only=True):
             # Drop the local db
             local('dropdb {}'.format(
                 config['local']['database']['name']
@@ -43,11 +41,16 @@ class Command(ServerManagementBaseCommand):
             ))
 
             # Import the database locally
-            local('psql -q {name} < ~/{name}.sql > /dev/null 2>&1'.format(
+            local('psql -q {name} < {path} > /dev/null 2>&1'.format(
                 name=config['local']['database']['name'],
+                path=dump_path,
             ))
 
-            # Cleanup local files
-            local('rm ~/{}.sql'.format(
-                config['local']['database']['name'],
-            ))
+        # Keep a copy to go back to with resetdb.
+        if options['snapshot']:
+            snapshots = SnapshotStore()
+            snapshot = snapshots.take(config['local']['database']['name'], config['remote_name'])
+            snapshots.evict()
+
+            if snapshot:
+                print(f'Saved the database as {snapshot}, run resetdb to go back to it.')
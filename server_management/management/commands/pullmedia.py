@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 from django.conf import settings as django_settings
 from fabric.api import env, hide, lcd, local, settings
@@ -6,6 +7,22 @@ from fabric.api import env, hide, lcd, local, settings
 from ._core import ServerManagementBaseCommand, load_config
 
 
+def received_files(log_path):
+    # The files rsync transferred, from a log written with `%i %n` (itemized
+    # changes and name) after its usual date and pid prefix.
+    received = []
+
+    with open(log_path, 'r', encoding='utf-8', errors='replace') as log_file:
+        for line in log_file:
+            _, _, entry = line.rstrip('\n').partition('] ')
+            changes, _, name = entry.partition(' ')
+
+            if changes.startswith('>f'):
+                received.append(name)
+
+    return received
+
+
 class Command(ServerManagementBaseCommand):
 
     def handle(self, *args, **options):
@@ -31,12 +48,19 @@ class Command(ServerManagementBaseCommand):
                 django_settings.STATIC_ROOT
             ))
 
-            local('rsync --progress -av{} --exclude "assets/" --exclude "cache/" {}@{}:/var/www/{}_media/ {}'.format(
-                ' ' if not getattr(env, 'key_filename') else ' -e "ssh -i {}"'.format(
-                    os.path.expanduser(env.key_filename),  # Fixes an rsync bug with ~ paths.
-                ),
-                env.user,
-                env.host_string,
-                project_folder,
-                django_settings.MEDIA_ROOT
-            ))
+            # The list of changed files lets pullall refresh just their thumbnails.
+            with tempfile.TemporaryDirectory() as folder:
+                log_path = os.path.join(folder, 'rsync.log')
+
+                local('rsync --progress -av{} --log-file={} --log-file-format="%i %n" --exclude "assets/" --exclude "cache/" {}@{}:/var/www/{}_media/ {}'.format(
+                    ' ' if not getattr(env, 'key_filename') else ' -e "ssh -i {}"'.format(
+                        os.path.expanduser(env.key_filename),  # Fixes an rsync bug with ~ paths.
+                    ),
+                    log_path,
+                    env.user,
+                    env.host_string,
+                    project_folder,
+                    django_settings.MEDIA_ROOT
+                ))
+
+                env.media_changes = received_files(log_path) if os.path.exists(log_path) else []
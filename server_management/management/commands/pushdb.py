@@ -16,8 +16,9 @@ class Command(ServerManagementBaseCommand):
         # Load server config from project
         config, remote = load_config(env, options.get('remote', ''), debug=options.get('debug', False))
 
+        # Always from a fresh dump, the remote is about to be overwritten.
         print('Making a backup')
-        perform_backup(env, config, remote)
+        perform_backup(env, config, remote, force=True)
         print('Backup made')
 
         with settings(warn_only=True):
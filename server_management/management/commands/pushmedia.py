@@ -1,14 +1,79 @@
+import json
 import os
+import tempfile
 
 from django.conf import settings as django_settings
 from fabric.api import env, hide, lcd, local, settings
 
-from ._core import ServerManagementBaseCommand, load_config
+from . import _dedup
+from ._backends import current_backend
+from ._core import ServerManagementBaseCommand, get_cache_dir, load_config
+
+
+def local_hashes(root):
+    # {relative path: sha1} for the local media, cached by size and mtime.
+    cache_path = os.path.join(get_cache_dir('state'), 'media-hashes.json')
+
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        cache = {}
+
+    hashes = {}
+    sizes = {}
+
+    for path in _dedup.find_files(root):
+        stat = os.stat(path)
+        entry = cache.get(path)
+
+        if not entry or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+            entry = cache[path] = [stat.st_size, stat.st_mtime_ns, _dedup.file_hash(path)]
+
+        relative_path = os.path.relpath(path, root)
+        hashes[relative_path] = entry[2]
+        sizes[relative_path] = entry[0]
+
+    with open(cache_path, 'w', encoding='utf-8') as cache_file:
+        json.dump(cache, cache_file)
+
+    return hashes, sizes
+
+
+def plan_push(local_digests, remote_digests):
+    # Splits the local files into those the server already has at the same
+    # path, those whose content it has somewhere else, and the rest.
+    remote_paths = {}
+    for path, digest in remote_digests.items():
+        remote_paths.setdefault(digest, path)
+
+    unchanged, links, uploads = [], [], []
+
+    for path, digest in sorted(local_digests.items()):
+        if remote_digests.get(path) == digest:
+            unchanged.append(path)
+        elif digest in remote_paths:
+            links.append([remote_paths[digest], path])
+        else:
+            uploads.append(path)
+
+    return unchanged, links, uploads
 
 
 class Command(ServerManagementBaseCommand):
 
-    def handle(self, *args, **options):
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+
+        parser.add_argument(
+            '--dry-run',
+            dest='dry_run',
+            action='store_true',
+            default=False,
+            help='Report what would be linked and uploaded, without changing anything.',
+        )
+
+    def handle(self, *args, **options):  # pylint: disable=too-many-locals
         # Load server config from project
         load_config(env, options.get('remote', ''), debug=options.get('debug', False))
 
@@ -23,14 +88,79 @@ class Command(ServerManagementBaseCommand):
                         local_project_path
                     ), capture=True)
 
-        with settings(warn_only=True):
-            local('rsync --rsync-path="sudo -u {} rsync" --progress --exclude "cache/" -O -av{} {}/ {}@{}:/var/www/{}_media/'.format(
-                project_folder,
-                ' ' if not getattr(env, 'key_filename') else ' -e "ssh -i {}"'.format(
-                    os.path.expanduser(env.key_filename),  # Fixes an rsync bug with ~ paths.
-                ),
-                django_settings.MEDIA_ROOT,
-                env.user,
-                env.host_string,
-                project_folder,
-            ))
+        backend = current_backend(env)
+        remote_root = f'/var/www/{project_folder}_media'
+        script = f'/tmp/server_management_dedup_{env.user}.py'
+
+        # Ask the server what it has while we hash the local files.
+        backend.put(_dedup.__file__, script, mode=0o644)
+        remote_hashes = backend.run_async(
+            f'python3 {script} hashes {remote_root} ~/.server-management-media.json',
+            user=project_folder,
+            quiet=True,
+        )
+        local_digests, sizes = local_hashes(django_settings.MEDIA_ROOT)
+        remote_hashes = remote_hashes.result()
+
+        # Anything unexpected (sudo warnings and the like) means uploading
+        # everything, as if the server had nothing.
+        try:
+            remote_digests = json.loads(str(remote_hashes).splitlines()[-1]) if remote_hashes.succeeded else {}
+        except (ValueError, IndexError):
+            remote_digests = {}
+        unchanged, links, uploads = plan_push(local_digests, remote_digests)
+
+        print('{} unchanged, {} linked from content already on the server ({:,} bytes saved), {} to upload ({:,} bytes).'.format(
+            len(unchanged),
+            len(links),
+            sum(sizes[path] for _, path in links),
+            len(uploads),
+            sum(sizes[path] for path in uploads),
+        ))
+
+        if options['dry_run']:
+            backend.run(f'rm -f {script}', quiet=True)
+            return
+
+        with tempfile.TemporaryDirectory() as folder:
+            if links:
+                plan_path = os.path.join(folder, 'plan.json')
+
+                with open(plan_path, 'w', encoding='utf-8') as plan_file:
+                    json.dump(links, plan_file)
+
+                linked = backend.put(plan_path, f'/tmp/server_management_dedup_{env.user}.json', mode=0o644).succeeded
+
+                if linked:
+                    linked = backend.run(
+                        f'python3 {script} link {remote_root} /tmp/server_management_dedup_{env.user}.json',
+                        user=project_folder,
+                    ).succeeded
+
+                # Upload them instead, rather than leave them missing.
+                if not linked:
+                    print('Linking files on the server failed, uploading them instead.')
+                    uploads = sorted(set(uploads) | {path for _, path in links})
+
+            backend.run(f'rm -f {script} /tmp/server_management_dedup_{env.user}.json', quiet=True)
+
+            if not uploads:
+                return
+
+            files_from = os.path.join(folder, 'files')
+
+            with open(files_from, 'w', encoding='utf-8') as files_from_file:
+                files_from_file.write('\n'.join(uploads) + '\n')
+
+            with settings(warn_only=True):
+                local('rsync --rsync-path="sudo -u {} rsync" --progress --files-from={} -O -av{} {}/ {}@{}:{}/'.format(
+                    project_folder,
+                    files_from,
+                    ' ' if not getattr(env, 'key_filename') else ' -e "ssh -i {}"'.format(
+                        os.path.expanduser(env.key_filename),  # Fixes an rsync bug with ~ paths.
+                    ),
+                    django_settings.MEDIA_ROOT,
+                    env.user,
+                    env.host_string,
+                    remote_root,
+                ))
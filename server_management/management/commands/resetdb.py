@@ -0,0 +1,58 @@
+import time
+
+from django.core.management.base import CommandError
+
+from ._core import ServerManagementBaseCommand, get_config, title_print
+from ._snapshots import SnapshotStore
+
+
+class Command(ServerManagementBaseCommand):
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+
+        parser.add_argument(
+            '--snapshot',
+            dest='snapshot',
+            default=None,
+            help='The snapshot to restore, the newest one (from --remote, if given) is used by default.',
+        )
+
+        parser.add_argument(
+            '--list',
+            dest='list',
+            action='store_true',
+            default=False,
+            help='List the snapshots of the local database.',
+        )
+
+    def handle(self, *args, **options):
+        database = get_config()['local']['database']['name']
+
+        snapshots = SnapshotStore()
+        snapshots.forget_missing()
+        found = snapshots.find(database, remote=options.get('remote'), name=options['snapshot'])
+
+        if options['list']:
+            for snapshot in found:
+                print('{}  {:<12} {:>8.1f} MB  {}'.format(
+                    time.strftime('%Y-%m-%d %H:%M', time.localtime(snapshot['created'])),
+                    snapshot['remote'],
+                    snapshot['size'] / 1024 / 1024,
+                    snapshot['name'],
+                ))
+            return
+
+        if not found:
+            raise CommandError(f'There are no snapshots of {database}, run pulldb first.')
+
+        title = 'Restoring {} from {}'.format(database, found[0]['name'])
+        title_print(title, state='task')
+
+        try:
+            snapshots.restore(found[0], database)
+        except BaseException:
+            title_print(title, state='failed')
+            raise
+
+        title_print(title, state='succeeded')
@@ -1,9 +1,16 @@
 from django.conf import settings as django_settings
-from fabric.api import (cd, env, hide, lcd, local, run, settings, shell_env,
-                        sudo)
-from fabvenv import virtualenv
+from django.template.loader import render_to_string
+from fabric.api import cd, env, hide, lcd, local, settings, shell_env, sudo
+from fabvenv import make_virtualenv, virtualenv
 
-from ._core import ServerManagementBaseCommand, load_config
+from ._configs import ConfigFile, configs_applied, upload_configs
+from ._core import (ServerManagementBaseCommand, load_config, report_step,
+                    run_tasks, start_report)
+from ._facts import gather_facts
+from ._git import fetch_script
+from ._static import precompress_tasks
+from ._tuning import (SUPERVISOR_NOFILE_CHECK, kernel_tuning,
+                      pgbouncer_options, service_tuning)
 
 
 class Command(ServerManagementBaseCommand):
@@ -44,8 +51,13 @@ class Command(ServerManagementBaseCommand):
         with hide('output', 'running', 'warnings'), lcd(local_project_path):
             project_folder = local(f"basename $( find {local_project_path} -name 'wsgi.py' -not -path '*/.venv/*' -not -path '*/venv/*' | xargs -0 -n1 dirname )", capture=True)
 
+        start_report(env, 'update')
+
+        with report_step(env, 'Gather server facts'):
+            facts = gather_facts(project_folder)
+
         with settings(sudo_user=project_folder), cd(f'/var/www/{project_folder}'):
-            initial_git_hash = run('git rev-parse --short HEAD')
+            initial_git_hash = facts['git_hash']
             old_venv = f'/var/www/{project_folder}/.venv-{initial_git_hash}'
 
             settings_module = '{}.settings.{}'.format(
@@ -57,57 +69,60 @@ class Command(ServerManagementBaseCommand):
             sudo('git config --global user.name "Onespacemedia Developers"')
             sudo('git config --global rebase.autoStash true')
 
-            sudo('git pull')
+            # Only the branch head (or the requested commit) is fetched, from
+            # the shared mirror if the checkout uses one.
+            with report_step(env, 'Pull the latest code'):
+                if options.get('commit', False):
+                    print('Pulling to specific commit.')
+                else:
+                    print('Pulling to HEAD')
+
+                sudo(fetch_script(options.get('commit')))
 
-            if options.get('commit', False):
-                print('Pulling to specific commit.')
-                sudo('git reset --hard {}'.format(
-                    options.get('commit', False),
-                ))
-            else:
-                print('Pulling to HEAD')
-                sudo('git reset --hard HEAD')
+            # One round-trip for the new hash and the venvs which exist.
+            with report_step(env, 'Gather server facts'):
+                facts = gather_facts(project_folder, refresh=True)
 
-            new_git_hash = run('git rev-parse --short HEAD')
+            new_git_hash = facts['git_hash']
             new_venv = f'/var/www/{project_folder}/.venv-{new_git_hash}'
 
             if initial_git_hash == new_git_hash and not options['force_update']:
                 print('Server is already up to date.')
                 exit()
 
-            # Does the new venv folder already exist?
-            with settings(warn_only=True):
-                venv_folder = run(f'test -d {new_venv}')
-
             # Build the virtualenv.
-            if venv_folder.return_code == 0:
+            if new_venv in facts['venv']:
                 print('Using existing venv for this commit hash')
-
-            if venv_folder.return_code > 0:
+            else:
                 print('Creating venv for this commit hash')
 
-                # Check if we have PyPy
-                with settings(warn_only=True):
-                    pypy = run('test -x /usr/bin/pypy')
-
-                if pypy.return_code == 0:
-                    sudo(f'virtualenv -p /usr/bin/pypy {new_venv}')
-                else:
-                    sudo(f'virtualenv -p python{python_version} {new_venv}')
+                # PyPy 2 has no venv module, so it still uses virtualenv.
+                venv_command = 'virtualenv -p /usr/bin/pypy' if facts['pypy'] else f'python{python_version} -m venv'
 
-                with virtualenv(new_venv), shell_env(DJANGO_SETTINGS_MODULE=settings_module):
-                    sudo('[[ -e requirements.txt ]] && pip install -r requirements.txt')
-                    sudo('pip install gunicorn')
+                with report_step(env, 'Create the virtualenv'), shell_env(DJANGO_SETTINGS_MODULE=settings_module):
+                    with settings(virtualenv=venv_command):
+                        make_virtualenv(
+                            new_venv,
+                            dependencies=['gunicorn'],
+                            system_site_packages=False,
+                            requirements='requirements.txt',
+                            user=project_folder,
+                        )
 
             # Things which need to happen regardless of whether there was a venv already.
-            with virtualenv(new_venv), shell_env(DJANGO_SETTINGS_MODULE=settings_module):
+            with virtualenv(new_venv, verify=False), shell_env(DJANGO_SETTINGS_MODULE=settings_module):
                 if remote['server'].get('build_system', 'npm') == 'npm':
-                    sudo('. ~/.nvm/nvm.sh && yarn', shell='/bin/bash')
-                    sudo('. ~/.nvm/nvm.sh && yarn run build', shell='/bin/bash')
+                    with report_step(env, 'Build the front end'):
+                        sudo('. ~/.nvm/nvm.sh && yarn', shell='/bin/bash')
+                        sudo('. ~/.nvm/nvm.sh && yarn run build', shell='/bin/bash')
+
+                with report_step(env, 'Collect static files'):
+                    sudo('python manage.py collectstatic --noinput -l')
 
-                sudo('python manage.py collectstatic --noinput -l')
+                run_tasks(env, precompress_tasks(f'/var/www/{project_folder}_static'), user=project_folder)
 
-                sudo('yes yes | python manage.py migrate')
+                with report_step(env, 'Run migrations'):
+                    sudo('yes yes | python manage.py migrate')
 
                 requirements = sudo('pip freeze')
 
@@ -115,8 +130,34 @@ class Command(ServerManagementBaseCommand):
                     if line.startswith('django-watson'):
                         sudo('python manage.py buildwatson')
 
+        # Keep the service sizing in step with the server's resources. This
+        # only touches supervisor if the rendered config has changed.
+        kernel = kernel_tuning(facts, remote['server'].get('kernel'))
+        supervisor_config = ConfigFile('/etc/supervisor/supervisord.conf', render_to_string('supervisor_config', {
+            'project': project_folder,
+            'tuning': service_tuning(facts, remote['server'].get('tuning')),
+            'kernel': kernel,
+            'pgbouncer': pgbouncer_options(facts, remote['database'].get('pgbouncer')),
+        }))
+
+        with report_step(env, 'Update the Supervisor config'):
+            if upload_configs([supervisor_config], title='Update the Supervisor config', use_sudo=True, trust_record=True):
+                sudo('supervisorctl reread && supervisorctl update')
+                configs_applied([supervisor_config])
+
         # Point the application to the new venv
-        sudo(f'rm -rf /var/www/{project_folder}/.venv')
-        sudo(f'ln -sf {new_venv} /var/www/{project_folder}/.venv')
-        sudo(f'rm -rf {old_venv}')
-        sudo(f'supervisorctl signal HUP {project_folder}')
+        with report_step(env, 'Switch to the new virtualenv'):
+            sudo(f'rm -rf /var/www/{project_folder}/.venv')
+            sudo(f'ln -sf {new_venv} /var/www/{project_folder}/.venv')
+            sudo(f'rm -rf {old_venv}')
+            sudo(f'supervisorctl signal HUP {project_folder}')
+
+        # minfds is only read when supervisord starts. Restarting it restarts
+        # the application too, so this waits until the new venv is in place.
+        run_tasks(env, [
+            {
+                'title': 'Restart Supervisor to raise its open file limit',
+                'command': 'service supervisord restart',
+                'check': SUPERVISOR_NOFILE_CHECK.format(nofile=kernel['nofile']),
+            },
+        ], user='root')
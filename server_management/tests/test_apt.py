@@ -0,0 +1,35 @@
+import subprocess
+
+from server_management.management.commands._apt import apt_tasks
+
+PROXY_FILE = '/etc/apt/apt.conf.d/01proxy'
+
+
+def run_proxy_task(tmp_path, **kwargs):
+    # Run the proxy task against a file in tmp_path rather than /etc.
+    task = apt_tasks(['git'], installed={'git'}, **kwargs)[0]
+    path = tmp_path / '01proxy'
+    path.write_text('Acquire::http::Proxy "http://old:3142";\n')
+
+    assert PROXY_FILE in task['command']
+    subprocess.run(['sh', '-c', task['command'].replace(PROXY_FILE, str(path))], check=True)
+    return path
+
+
+def test_proxy_is_configured(tmp_path):
+    path = run_proxy_task(tmp_path, proxy='http://10.0.0.2:3142')
+
+    assert path.read_text() == 'Acquire::http::Proxy "http://10.0.0.2:3142";\n'
+
+
+def test_proxy_is_removed_without_apt_proxy(tmp_path):
+    path = run_proxy_task(tmp_path, proxy=None)
+
+    assert not path.exists()
+
+
+def test_only_missing_packages_are_installed():
+    tasks = apt_tasks(['git', 'nginx', ''], installed={'git'})
+
+    assert tasks[-1]['command'] == 'apt-get install -y nginx'
+    assert [task['title'] for task in tasks].count('Update apt cache') == 1
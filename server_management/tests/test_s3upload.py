@@ -0,0 +1,165 @@
+import hashlib
+import hmac
+import io
+import re
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from server_management.management.commands._s3upload import upload
+
+ACCESS_KEY = 'AKIDEXAMPLE'
+SECRET_KEY = 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY'
+REGION = 'eu-west-1'
+
+
+def hmac_sha256(key, message):
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256)
+
+
+def expected_signature(method, path, query, headers):
+    # Signature Version 4, worked out from the request as it arrived.
+    signed = sorted(headers)
+    canonical_request = '\n'.join([
+        method,
+        path,
+        '&'.join(
+            '{}={}'.format(urllib.parse.quote(name, safe='~'), urllib.parse.quote(value, safe='~'))
+            for name, value in sorted(urllib.parse.parse_qsl(query, keep_blank_values=True))
+        ),
+        ''.join('{}:{}\n'.format(name, headers[name]) for name in signed),
+        ';'.join(signed),
+        headers['x-amz-content-sha256'],
+    ])
+    date = headers['x-amz-date'][:8]
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256',
+        headers['x-amz-date'],
+        '{}/{}/s3/aws4_request'.format(date, REGION),
+        hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+    ])
+
+    key = ('AWS4' + SECRET_KEY).encode('utf-8')
+    for part in (date, REGION, 's3', 'aws4_request'):
+        key = hmac_sha256(key, part).digest()
+    return hmac_sha256(key, string_to_sign).hexdigest()
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    # Just enough of the multipart upload API, recording each request.
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def respond(self, body=b'', headers=None):
+        self.send_response(200)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self):
+        path, _, query = self.path.partition('?')
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        signed = re.search(r'SignedHeaders=([^,]+)', self.headers['Authorization']).group(1).split(';')
+        headers = {name: self.headers[name] for name in signed}
+
+        self.server.requests.append({
+            'method': self.command,
+            'path': path,
+            'query': dict(urllib.parse.parse_qsl(query, keep_blank_values=True)),
+            'body': body,
+            'authorization': self.headers['Authorization'],
+            'signature': expected_signature(self.command, path, query, headers),
+            'payload_hash': hashlib.sha256(body).hexdigest() == headers['x-amz-content-sha256'],
+        })
+        return body
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self.handle_request()
+
+        if self.path.endswith('?uploads='):
+            self.respond(b'<InitiateMultipartUploadResult><UploadId>upload-1</UploadId></InitiateMultipartUploadResult>')
+        else:
+            self.respond(b'<CompleteMultipartUploadResult><Key>backup.sql.gz</Key></CompleteMultipartUploadResult>')
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        body = self.handle_request()
+        self.respond(headers={'ETag': '"{}"'.format(hashlib.md5(body).hexdigest())})
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        self.handle_request()
+        self.respond()
+
+
+@pytest.fixture
+def s3_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), S3Handler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_job(server, **kwargs):
+    job = {
+        'endpoint': 'http://127.0.0.1:{}'.format(server.server_address[1]),
+        'region': REGION,
+        'access_key_id': ACCESS_KEY,
+        'secret_access_key': SECRET_KEY,
+        'bucket': 'backups',
+        'key': 'example/backup.sql.gz',
+        'part_size': 1024,
+        'concurrency': 2,
+    }
+    job.update(kwargs)
+    return job
+
+
+def test_upload_in_parts(s3_server, tmp_path):
+    done = tmp_path / 'done'
+    done.touch()
+    data = bytes(range(256)) * 10
+
+    result = upload(make_job(s3_server, complete_if=str(done)), io.BytesIO(data))
+    requests = s3_server.requests
+
+    assert result == {'key': 'example/backup.sql.gz', 'size': len(data), 'parts': 3}
+    assert not done.exists()
+    assert [(request['method'], sorted(request['query'])) for request in requests] == (
+        [('POST', ['uploads'])] + [('PUT', ['partNumber', 'uploadId'])] * 3 + [('POST', ['uploadId'])]
+    )
+    assert all(request['path'] == '/backups/example/backup.sql.gz' for request in requests)
+    assert all(request['query'].get('uploadId', 'upload-1') == 'upload-1' for request in requests)
+
+    parts = sorted((int(request['query']['partNumber']), request['body']) for request in requests[1:4])
+    assert b''.join(body for _, body in parts) == data
+    assert requests[-1]['body'].decode('utf-8') == ''.join(
+        ['<CompleteMultipartUpload>'] + [
+            '<Part><PartNumber>{}</PartNumber><ETag>"{}"</ETag></Part>'.format(number, hashlib.md5(body).hexdigest())
+            for number, body in parts
+        ] + ['</CompleteMultipartUpload>']
+    )
+
+    for request in requests:
+        assert request['payload_hash']
+        assert request['authorization'].startswith('AWS4-HMAC-SHA256 Credential={}/'.format(ACCESS_KEY))
+        assert '/{}/s3/aws4_request, SignedHeaders=host;x-amz-content-sha256;x-amz-date, '.format(REGION) in request['authorization']
+        assert request['authorization'].endswith('Signature=' + request['signature'])
+
+
+def test_upload_is_aborted_when_the_input_ends_early(s3_server, tmp_path):
+    job = make_job(s3_server, complete_if=str(tmp_path / 'done'))
+
+    with pytest.raises(IOError, match='ended early'):
+        upload(job, io.BytesIO(b'partial dump'))
+
+    requests = s3_server.requests
+    assert [request['method'] for request in requests] == ['POST', 'PUT', 'DELETE']
+    assert requests[-1]['query'] == {'uploadId': 'upload-1'}
+    assert requests[-1]['authorization'].endswith('Signature=' + requests[-1]['signature'])